@@ -0,0 +1,85 @@
+"""A stand-in for the rmapi binary, keeping the reMarkable cloud in a local folder.
+
+Supports the commands used by remarkable.py, both one-shot (`rmapi -ni ls
+Substack`) and as a shell reading commands from stdin. Every command waits
+RMAPI_FAKE_LATENCY_MS first, to model the round trip to the cloud.
+"""
+import json
+import os
+import shlex
+import shutil
+import sys
+import time
+
+ROOT = os.environ.get('RMAPI_FAKE_ROOT', os.path.join(os.path.expanduser('~'), 'fake-remarkable'))
+if os.environ.get('RMAPI_CONFIG'):
+    # A cloud per account, named after the folder of its config file
+    ROOT = os.path.join(ROOT, os.path.basename(os.path.dirname(os.path.abspath(os.environ['RMAPI_CONFIG']))))
+LATENCY = float(os.environ.get('RMAPI_FAKE_LATENCY_MS', '0')) / 1000
+
+def _path(remote):
+    return os.path.join(ROOT, remote.strip('/'))
+
+def run(cmd):
+    if not cmd:
+        return
+    time.sleep(LATENCY)
+    verb, args = cmd[0], cmd[1:]
+    if verb == 'version':
+        print('rmapi version: fake')
+    elif verb == 'ls':
+        folder = _path(args[0] if args else '/')
+        if not os.path.isdir(folder):
+            print("Error: directory doesn't exist")
+            return
+        for name in sorted(os.listdir(folder)):
+            if os.path.isdir(os.path.join(folder, name)):
+                print(f'[d]\t{name}')
+            elif name.endswith('.json'):
+                print(f'[f]\t{name[:-len(".json")]}')
+    elif verb == 'mkdir':
+        os.makedirs(_path(args[0]), exist_ok=True)
+    elif verb == 'put':
+        local, folder = args
+        name = os.path.splitext(os.path.basename(local))[0]
+        meta = os.path.join(_path(folder), f'{name}.json')
+        if not os.path.isdir(_path(folder)):
+            print("Error: directory doesn't exist")
+        elif os.path.exists(meta):
+            print('Error: entry already exists')
+        else:
+            shutil.copyfile(local, os.path.join(_path(folder), f'{name}.pdf'))
+            with open(meta, 'w') as f:
+                json.dump({'VissibleName': name, 'CurrentPage': 0}, f)
+            print(f'uploading: [{local}]...')
+    elif verb == 'stat':
+        meta = f'{_path(args[0])}.json'
+        if not os.path.exists(meta):
+            print("Error: entry doesn't exist")
+            return
+        with open(meta, 'r') as f:
+            print(json.dumps(json.load(f), indent=2))
+    elif verb == 'rm':
+        meta = f'{_path(args[0])}.json'
+        if not os.path.exists(meta):
+            print("Error: entry doesn't exist")
+            return
+        os.remove(meta)
+        if os.path.exists(f'{_path(args[0])}.pdf'):
+            os.remove(f'{_path(args[0])}.pdf')
+    else:
+        print(f'Error: unknown command {verb}')
+
+def main():
+    args = [a for a in sys.argv[1:] if a != '-ni']
+    if args:
+        run(args)
+        return
+    print('ReMarkable Cloud API Shell, User: bench')
+    for line in sys.stdin:
+        sys.stdout.write('[/]>')
+        run(shlex.split(line))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
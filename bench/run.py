@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Benchmarks main.py end to end without Substack or reMarkable accounts.
+
+For each article count, runs main.py twice against a local Substack
+stand-in (bench/server.py) and a fake rmapi (bench/fake_rmapi.py): a cold
+run which renders and uploads every article, then a warm run with nothing
+new. Reports the wall time of each run and the per-stage timings main.py
+writes to metrics.jsonl.
+
+    python3 bench/run.py --articles 4 20 --rmapi-latency-ms 200
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from server import BenchServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+def setup(root):
+    """Creates a home folder with rmapi credentials, a fake rmapi on PATH and long-lived Substack cookies."""
+    home = os.path.join(root, 'home')
+    bin_dir = os.path.join(root, 'bin')
+    config = os.path.join(root, 'config')
+    for d in (home, bin_dir, config, os.path.join(root, 'tmp')):
+        os.makedirs(d)
+    with open(os.path.join(home, '.rmapi'), 'w') as f:
+        f.write('devicetoken: bench\nusertoken: bench\n')
+    rmapi = os.path.join(bin_dir, 'rmapi')
+    with open(rmapi, 'w') as f:
+        f.write(f'#!/bin/sh\nexec {sys.executable} {os.path.join(BENCH_DIR, "fake_rmapi.py")} "$@"\n')
+    os.chmod(rmapi, 0o755)
+    with open(os.path.join(config, '.substack-cookie'), 'w') as f:
+        json.dump([{'name': 'substack.sid', 'value': 'bench', 'domain': '.substack.com', 'path': '/',
+                    'expires': time.time() + 365*24*60*60, 'httpOnly': True, 'secure': True, 'sameSite': 'Lax'}], f)
+    return home, bin_dir, config
+
+def run_main(root, base_url, count, args, extra_args):
+    home = os.path.join(root, 'home')
+    env = {
+        **os.environ,
+        'HOME': home,
+        # Keep using the browsers installed under the real home folder
+        'PLAYWRIGHT_BROWSERS_PATH': os.environ.get('PLAYWRIGHT_BROWSERS_PATH', os.path.expanduser('~/.cache/ms-playwright')),
+        'PATH': f'{os.path.join(root, "bin")}{os.pathsep}{os.environ.get("PATH", "")}',
+        'SUBSTACK_BASE_URL': base_url,
+        'RMAPI_FAKE_ROOT': os.path.join(root, 'remarkable'),
+        'RMAPI_FAKE_LATENCY_MS': str(args.rmapi_latency_ms),
+    }
+    cmd = [sys.executable, '-u', os.path.join(REPO_DIR, 'main.py'),
+           '--config-folder', os.path.join(root, 'config'),
+           '--tmp-folder', os.path.join(root, 'tmp'),
+           '--max-save-count', str(count),
+           '--max-fetch-count', str(count),
+           '--rate-limit', '1000', '--rate-burst', '1000',
+           *extra_args]
+    metrics_file = os.path.join(root, 'config', 'metrics.jsonl')
+    seen = 0
+    if os.path.exists(metrics_file):
+        with open(metrics_file, 'r') as f:
+            seen = sum(1 for _ in f)
+
+    start = time.monotonic()
+    with open(os.path.join(root, 'main.log'), 'a') as log:
+        ret = subprocess.run(cmd, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=REPO_DIR)
+    elapsed = time.monotonic() - start
+
+    records = []
+    if os.path.exists(metrics_file):
+        with open(metrics_file, 'r') as f:
+            records = [json.loads(line) for line in list(f)[seen:]]
+    return ret.returncode, elapsed, records
+
+def summarize(records):
+    totals = {}
+    for r in records:
+        if r['name'] == 'run_stage_seconds':
+            key = f"stage.{r['stage']}"
+        elif r['name'] == 'render_seconds':
+            key = f"render.{r['renderer']}"
+        elif r['name'] == 'render_stage_seconds':
+            key = f"render_stage.{r['stage']}"
+        elif r['name'] == 'rmapi_seconds':
+            key = f"rmapi.{r['verb']}"
+        else:
+            continue
+        t = totals.setdefault(key, [0, 0])
+        t[0] += 1
+        t[1] += r['value']
+    return totals
+
+def main():
+    a = argparse.ArgumentParser(description='Benchmarks main.py against a local Substack and a fake rmapi')
+    a.add_argument('--articles', type=int, nargs='+', default=[4, 20], help='Article counts to benchmark')
+    a.add_argument('--api-latency-ms', type=int, default=50, help='Latency of each Substack API response')
+    a.add_argument('--page-latency-ms', type=int, default=200, help='Latency of each Substack page load')
+    a.add_argument('--rmapi-latency-ms', type=int, default=100, help='Latency of each rmapi command')
+    a.add_argument('--keep', action='store_true', help='Keep the temporary folders, with main.py\'s log, for inspection')
+    args, extra_args = a.parse_known_args()
+    if extra_args and extra_args[0] == '--':
+        extra_args = extra_args[1:]
+
+    results = []
+    for count in args.articles:
+        root = tempfile.mkdtemp(prefix=f'bench-{count}-')
+        setup(root)
+        with BenchServer(count, args.api_latency_ms / 1000, args.page_latency_ms / 1000) as server:
+            for run in ('cold', 'warm'):
+                code, elapsed, records = run_main(root, server.base_url, count, args, extra_args)
+                uploaded = sum(r['value'] for r in records if r['name'] == 'articles_total' and r.get('result') == 'uploaded')
+                print(f'{count} articles, {run} run: {elapsed:.1f}s, exit code {code}, {uploaded} uploaded')
+                for key, (n, total) in sorted(summarize(records).items()):
+                    print(f'    {key:<28} n={n:<4} total={total:8.2f}s')
+                results.append((count, run, code, elapsed, uploaded))
+                if code != 0:
+                    print(f'    main.py failed, see {os.path.join(root, "main.log")}')
+        if args.keep or any(r[2] != 0 for r in results if r[0] == count):
+            print(f'    kept {root}')
+        else:
+            shutil.rmtree(root)
+
+    print()
+    print(f'{"articles":>8} {"run":>5} {"exit":>4} {"seconds":>8} {"uploaded":>8}')
+    for count, run, code, elapsed, uploaded in results:
+        print(f'{count:>8} {run:>5} {code:>4} {elapsed:>8.1f} {uploaded:>8}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""A local stand-in for the parts of Substack used by main.py.
+
+Serves the subscriptions, reader feed and post APIs, a logged-in home page,
+and synthetic article pages of a few kinds, with configurable latency.
+"""
+import json
+import random
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+KINDS = ['short', 'long', 'images', 'paywalled']
+PARAGRAPHS = {'short': 5, 'long': 200, 'images': 10, 'paywalled': 30}
+PUBLICATIONS = {1: 'Bench Weekly', 2: 'Bench Daily'}
+
+PARAGRAPH = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor '
+             'incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud '
+             'exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat.')
+
+def png(width, height, seed):
+    """Returns an RGB gradient PNG, which compresses about as well as a photo."""
+    rng = random.Random(seed)
+    rows = []
+    for y in range(height):
+        row = bytearray([0])
+        for x in range(width):
+            row += bytes([(x * 255 // width + rng.randrange(32)) % 256, (y * 255 // height) % 256, rng.randrange(256)])
+        rows.append(bytes(row))
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(b''.join(rows)))
+            + chunk(b'IEND', b''))
+
+class Articles:
+    def __init__(self, base_url, count):
+        self.base_url = base_url
+        now = datetime.now(timezone.utc)
+        self.posts = []
+        for i in range(count):
+            kind = KINDS[i % len(KINDS)]
+            self.posts.append({
+                'id': 1000 + i,
+                'publication_id': 1 + i % len(PUBLICATIONS),
+                'post_date': (now - timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'title': f'Bench article {i} ({kind})',
+                'subtitle': f'A {kind} article',
+                'slug': f'bench-{i}-{kind}',
+                'canonical_url': f'{base_url}/p/bench-{i}-{kind}',
+                'audience': 'only_paid' if kind == 'paywalled' else 'everyone',
+                'publishedBylines': [{'name': 'Bench Author'}],
+                'wordcount': PARAGRAPHS[kind] * len(PARAGRAPH.split()),
+                'kind': kind,
+            })
+        self.by_slug = {p['slug']: p for p in self.posts}
+
+    def body_html(self, post, full=True):
+        parts = []
+        for i in range(PARAGRAPHS[post['kind']]):
+            parts.append(f'<p>{PARAGRAPH}</p>')
+            if post['kind'] == 'images':
+                parts.append(f'<figure><img src="/img/{i}.png" loading="lazy" width="1200" height="800">'
+                             f'<figcaption>Figure {i}</figcaption></figure>')
+            if post['kind'] == 'paywalled' and not full and i == 2:
+                parts.append('<div class="paywall"><h2>This post is for paid subscribers</h2></div>')
+                break
+        return '\n'.join(parts)
+
+    def subscriptions(self):
+        return {'publications': [{'id': id, 'name': name} for id, name in PUBLICATIONS.items()]}
+
+    def reader_posts(self, limit, after):
+        posts = [p for p in self.posts if not after or p['post_date'] < after][:limit]
+        return {'posts': posts, 'more': len(posts) == limit}
+
+    def post(self, slug):
+        post = self.by_slug[slug]
+        # Paid posts come back cut off at the paywall, as they do for custom domains
+        return {**post, 'body_html': self.body_html(post, full=post['kind'] != 'paywalled')}
+
+    def page(self, slug):
+        post = self.by_slug[slug]
+        return f'''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{post['title']}</title></head>
+<body>
+<div class="topbar"><button>New post</button></div>
+<article>
+<h1>{post['title']}</h1>
+<div class="available-content"><div class="body markup">{self.body_html(post)}</div></div>
+</article>
+<div id="discussion">Comments</div>
+<div class="footer">Footer</div>
+</body></html>'''
+
+def make_handler(articles, api_latency, page_latency):
+    images = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _json(self, obj):
+            time.sleep(api_latency)
+            self._send(200, json.dumps(obj).encode(), 'application/json')
+
+        def do_GET(self):
+            u = urllib.parse.urlsplit(self.path)
+            q = dict(urllib.parse.parse_qsl(u.query))
+            if u.path == '/api/v1/subscriptions':
+                return self._json(articles.subscriptions())
+            if u.path == '/api/v1/reader/posts':
+                return self._json(articles.reader_posts(int(q.get('limit', 12)), q.get('after')))
+            if u.path.startswith('/api/v1/posts/'):
+                slug = u.path.rsplit('/', 1)[1]
+                if slug not in articles.by_slug:
+                    return self._send(404, b'{}', 'application/json')
+                return self._json(articles.post(slug))
+            if u.path == '/home':
+                time.sleep(page_latency)
+                return self._send(200, b'<html><body><button>New post</button></body></html>', 'text/html')
+            if u.path.startswith('/p/'):
+                slug = u.path.rsplit('/', 1)[1]
+                if slug not in articles.by_slug:
+                    return self._send(404, b'Not found', 'text/plain')
+                time.sleep(page_latency)
+                return self._send(200, articles.page(slug).encode(), 'text/html')
+            if u.path.startswith('/img/'):
+                if u.path not in images:
+                    images[u.path] = png(600, 400, u.path)
+                return self._send(200, images[u.path], 'image/png')
+            self._send(404, b'Not found', 'text/plain')
+
+    return Handler
+
+class BenchServer:
+    def __init__(self, count, api_latency=0, page_latency=0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), None)
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.articles = Articles(self.base_url, count)
+        self.httpd.RequestHandlerClass = make_handler(self.articles, api_latency, page_latency)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
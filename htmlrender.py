@@ -0,0 +1,113 @@
+import html
+import re
+
+from pdfutil import DEVICE_PROFILES
+
+try:
+    import weasyprint
+except ImportError:
+    weasyprint = None
+
+PRINT_CSS = '''
+html, body {
+    font-family: Georgia, 'Times New Roman', serif;
+    font-size: 12pt;
+    line-height: 1.5;
+    color: #000;
+    background: #fff;
+}
+h1 {
+    font-size: 22pt;
+    line-height: 1.2;
+    margin: 0 0 4pt;
+}
+h3.subtitle {
+    font-weight: normal;
+    color: #444;
+    margin: 0 0 8pt;
+}
+p.byline {
+    font-size: 10pt;
+    color: #444;
+    margin: 0 0 16pt;
+}
+img, video, iframe {
+    max-width: 100%;
+    height: auto;
+}
+figure {
+    margin: 12pt 0;
+    break-inside: avoid;
+}
+figcaption {
+    font-size: 10pt;
+    color: #444;
+}
+pre, code {
+    white-space: pre-wrap;
+    font-size: 10pt;
+}
+blockquote {
+    margin-left: 0;
+    padding-left: 12pt;
+    border-left: 2pt solid #888;
+}
+.subscription-widget-wrap, .subscription-widget-wrap-editor, .button-wrapper,
+.captioned-button-wrap, .image-link-expand, .footnote-anchor-email, .share-dialog {
+    display: none !important;
+}
+'''
+
+PAYWALL_RE = re.compile(r'class="[^"]*\bpaywall')
+
+def readable_body(post):
+    """Returns the post's body_html if it holds the whole article, or None if it is cut off by a paywall."""
+    body = post.get('body_html')
+    if not body or PAYWALL_RE.search(body):
+        return None
+    return body
+
+def article_html(post, body, device='a4'):
+    bylines = ', '.join(b['name'] for b in post.get('publishedBylines') or [] if b.get('name'))
+    date = (post.get('post_date') or '')[:10]
+    subtitle = f'<h3 class="subtitle">{html.escape(post["subtitle"])}</h3>' if post.get('subtitle') else ''
+    return f'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<base href="{html.escape(post['canonical_url'])}">
+<title>{html.escape(post.get('title') or '')}</title>
+<style>
+@page {{
+    size: {DEVICE_PROFILES[device]['size']};
+    margin: {DEVICE_PROFILES[device]['margin']};
+}}
+{PRINT_CSS}
+</style>
+</head>
+<body>
+<article>
+<h1>{html.escape(post.get('title') or '')}</h1>
+{subtitle}
+<p class="byline">{html.escape(' · '.join(filter(None, [bylines, date])))}</p>
+{body}
+</article>
+</body>
+</html>'''
+
+def fetch_article_html(ss, url, device='a4'):
+    """Builds a printable page for the article at url from the post API, or returns None if it has to be rendered in the browser."""
+    try:
+        post = ss.get_post(url)
+    except Exception as e:
+        print(f'Unable to fetch {url} from the post API, rendering it in the browser: {e}')
+        return None
+    body = readable_body(post)
+    if not body:
+        print(f'{url} is paywalled in the post API, rendering it in the browser')
+        return None
+    return article_html(post, body, device)
+
+def write_pdf(page_html, base_url):
+    """Returns the bytes of the PDF of page_html."""
+    return weasyprint.HTML(string=page_html, base_url=base_url).write_pdf()
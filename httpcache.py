@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import time
+
+class HttpCache:
+    """On-disk cache of JSON API responses.
+
+    Cached responses are revalidated with If-None-Match/If-Modified-Since, or
+    reused without a request at all while younger than the ttl passed to fresh().
+    """
+    def __init__(self, folder, max_age=7*24*60*60):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.prune(max_age)
+
+    def _path(self, url):
+        return os.path.join(self.folder, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def _load(self, url):
+        try:
+            with open(self._path(url), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def _save(self, url, entry):
+        path = self._path(url)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(entry))
+        os.replace(tmp, path)
+
+    def prune(self, max_age):
+        now = time.time()
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def fresh(self, url, ttl):
+        """Returns the cached body for url if it is younger than ttl seconds."""
+        entry = self._load(url)
+        if entry and ttl is not None and time.time() - entry['fetched'] < ttl:
+            print(f'Using cached response for {url}')
+            return entry['body']
+        return None
+
+    def request_headers(self, url):
+        """Returns the headers to make a request for url conditional on the cached copy."""
+        entry = self._load(url)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, r, ttl=None):
+        """Returns the JSON body of response r, caching it or reusing the cached copy on a 304."""
+        entry = self._load(url)
+        if r.status_code == 304 and entry:
+            print(f'Cached response for {url} not modified')
+            entry['fetched'] = time.time()
+            self._save(url, entry)
+            return entry['body']
+        if r.status_code//100 != 2:
+            raise RuntimeError(f'{r.status_code}: {r.text}')
+
+        body = r.json()
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if etag or last_modified or ttl is not None:
+            self._save(url, {
+                'url': url,
+                'fetched': time.time(),
+                'etag': etag,
+                'last_modified': last_modified,
+                'body': body,
+            })
+        return body
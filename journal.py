@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+class Journal:
+    """Append-only record of each article's progress through a sync run.
+
+    Every stage an article completes (discovered, rendered, uploaded, deleted)
+    is appended and flushed as it happens, so a run which is killed part way
+    through can be resumed from the last completed stage.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        truncated = False
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        self._merge(json.loads(line))
+                    except ValueError:
+                        # the last line may be cut short if we were killed mid-write
+                        print(f'Ignoring malformed journal line: {line!r}')
+                    truncated = not line.endswith('\n')
+        self.f = open(path, 'a')
+        if truncated:
+            self.f.write('\n')
+
+    def _merge(self, record):
+        entry = self.entries.setdefault(record['id'], {'stages': []})
+        entry.update({k: v for k, v in record.items() if k != 'stage'})
+        entry['stages'].append(record['stage'])
+
+    def record(self, article_id, stage, **fields):
+        record = {**fields, 'id': article_id, 'stage': stage, 'ts': time.time()}
+        with self.lock:
+            self.f.write(json.dumps(record) + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self._merge(record)
+
+    def get(self, id):
+        return self.entries.get(id)
+
+    def has(self, id, stage):
+        return stage in self.entries.get(id, {}).get('stages', [])
+
+    def compact(self, keep):
+        """Rewrites the journal with only the entries for which keep(id, entry) is true."""
+        with self.lock:
+            self.f.close()
+            self.entries = {id: e for id, e in self.entries.items() if keep(id, e)}
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w') as f:
+                for id, entry in self.entries.items():
+                    for stage in entry['stages']:
+                        fields = {k: v for k, v in entry.items() if k != 'stages'}
+                        f.write(json.dumps({**fields, 'stage': stage}) + '\n')
+            os.replace(tmp, self.path)
+            self.f = open(self.path, 'a')
+
+    def close(self):
+        self.f.close()
+
+def file_checksum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
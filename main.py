@@ -4,15 +4,26 @@ import re
 import tempfile
 import os
 import json
-import pypdf
 import time
 import subprocess
+import signal
+import sys
+import random
+import traceback
 
 from remarkable import Remarkable
-from sstack import Substack
-from playwright_stealth import Stealth
-from playwright.sync_api import sync_playwright
+from sstack import Substack, RateLimiter
+from renderpool import RenderPool
+from httpcache import HttpCache
+from journal import Journal, file_checksum
+from store import ArticleStore
+from rendercache import RenderCache, post_revision
+from htmlrender import fetch_article_html
+from pdfutil import DEVICE_PROFILES, pdf_info
+from metrics import metrics, RssSampler
+from requestfilter import RequestFilter
 
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
 
 def parse_args():
@@ -21,15 +32,44 @@ def parse_args():
     a.add_argument('--max-fetch-count', type=int, default=20, help='Maximum number of articles to fetch from Substack')
     a.add_argument('--delete-already-read', action='store_true', help='Delete articles in reMarkable cloud which are already read')
     a.add_argument('--delete-unread-after-hours', type=int, default=48, help='If an article has not been opened for this many hours on the device and there are new articles to add, will delete. Set to -1 to disable, or 0 to always replace old articles.')
+    a.add_argument('--full-rescan', action='store_true', help='Fetch up to --max-fetch-count posts even if they are older than the newest post seen on the previous run')
     a.add_argument('--folder', default='Substack', help='Folder title to write to')
     a.add_argument('--remarkable-auth-token', help='For initial authentication with reMarkable: device token')
+    a.add_argument('--rmapi-config', help='rmapi config file holding the reMarkable tokens, instead of ~/.rmapi')
     a.add_argument('--substack-login-url', help='For initial authentication with Substack: the URL from the email received from Substack when entering your email on the login page')
     a.add_argument('--config-folder', help='Configuration folder for remarkable-substack')
     a.add_argument('--tmp-folder', help='Temporary storage folder for remarkable-substack')
+    a.add_argument('--subscriptions-cache-hours', type=float, default=24, help='Reuse the cached list of subscribed publications for this many hours')
     a.add_argument('--relogin-command', help='Command to run when relogin is required to substack (e.g. send a notification)', default=None)
     a.add_argument('--remarkable-relogin-command', help='Command to run when relogin is required to remarkable (e.g. send a notification)', default=None)
+    a.add_argument('--upload-concurrency', type=int, default=1, help='Number of articles to upload to reMarkable cloud in parallel, each with its own rmapi process')
+    a.add_argument('--upload-retries', type=int, default=2, help='Number of times to retry a failed upload')
+    a.add_argument('--rmapi-one-shot', action='store_true', help='Run a separate rmapi process for every operation instead of keeping one rmapi shell open')
     a.add_argument('--non-headless', help='Debug by not having headless browser', action='store_true')
     a.add_argument('--slow-mo', help='Slow down browser actions by this many milliseconds', default=0, type=int)
+    a.add_argument('--render-concurrency', type=int, default=1, help='Number of articles to render in parallel, each in its own browser')
+    a.add_argument('--rate-limit', type=float, default=0.5, help='Maximum sustained requests per second to each Substack host, for both API calls and page loads')
+    a.add_argument('--rate-burst', type=int, default=4, help='Number of requests to a host which may be made back to back before --rate-limit applies')
+    a.add_argument('--max-429-retries', type=int, default=5, help='Give up on a request after it was rate limited this many times')
+    a.add_argument('--render-timeout', type=float, default=120, help='Give up on rendering an article attempt after this many seconds')
+    a.add_argument('--report-wait-time', action='store_true', help='Print how much of each article render was spent waiting on the page')
+    a.add_argument('--lazy-load-mode', choices=['inpage', 'scroll'], default='inpage', help='How to load lazy images before rendering: in a single page script, or by scrolling through the page')
+    a.add_argument('--device', choices=DEVICE_PROFILES.keys(), default='a4', help='Device to size article pages and images for: a4 paper, reMarkable 2 (rm2) or reMarkable Paper Pro (paperpro)')
+    a.add_argument('--renderer', choices=['html', 'browser'], default='html', help='Render articles whose full text is in the post API from that HTML (with weasyprint if installed), only loading the article in the browser when it is paywalled; or always load the article in the browser')
+    a.add_argument('--no-request-filter', action='store_true', help='Let article pages load analytics, embedded players and media, which are blocked by default. Blocked hosts and per-publication allow lists can be set in request-filter.json in the config folder')
+    a.add_argument('--recycle-page-after', type=int, default=10, help='Open a fresh browser page after rendering this many articles in one. Set to 0 to disable')
+    a.add_argument('--recycle-context-mb', type=int, default=450, help='Recycle a render browser\'s context, keeping its cookies, when the memory (PSS) of that browser\'s processes passes this many MB. Set to 0 to disable')
+    a.add_argument('--postprocess-workers', type=int, default=2, help='Number of processes checking and optimizing rendered PDFs. Blank and paywalled renders, and ones much shorter than the post\'s wordcount, aren\'t uploaded')
+    a.add_argument('--strip-pdf-metadata', action='store_true', help='Remove the document information and XMP metadata from rendered PDFs')
+    a.add_argument('--render-cache-mb', type=int, default=200, help='Size of the cache of rendered PDFs in the config folder, used when an article has to be uploaded again. Set to 0 to disable')
+    a.add_argument('--cookie-refresh-hours', type=int, default=24, help='Refresh the saved Substack cookies in a browser when they expire within this many hours')
+    a.add_argument('--metrics-file', default='metrics.jsonl', help='File in the config folder to append per-stage timings and counters to as JSON lines. Set to an empty string to disable')
+    a.add_argument('--prometheus-textfile', action='store_true', help='Also write the run\'s metrics to metrics.prom in the config folder, for the node exporter textfile collector')
+    a.add_argument('--daemon', action='store_true', help='Keep running and sync every --poll-minutes, keeping rmapi, the article store and the render browsers open between syncs')
+    a.add_argument('--poll-minutes', type=float, default=30, help='In --daemon mode, minutes between syncs')
+    a.add_argument('--poll-jitter-minutes', type=float, default=5, help='In --daemon mode, add a random delay of up to this many minutes to each poll')
+    a.add_argument('--accounts', help='JSON file listing accounts to sync from one process, which share the render browsers. Each account is an object with a name and the options which differ from the command line\'s, which must include config_folder, e.g. [{"name": "alice", "config_folder": "/data/alice", "rmapi_config": "/data/alice/rmapi.conf"}]')
+    a.add_argument('--login-check-minutes', type=float, default=None, help='Re-verify the substack.com login after this many minutes while rendering (default: once per run)')
     return a.parse_args()
 
 def parse_filename(fn):
@@ -41,109 +81,196 @@ def parse_filename(fn):
     return None
 
 
-def main(args):
-    try:
-        rm = Remarkable()
-        rm.auth_if_needed(args.remarkable_auth_token)
-    except Exception as e:
-        if args.remarkable_relogin_command:
-            subprocess.run(['/bin/bash', '-c', args.remarkable_relogin_command])
-        raise e
-
-    if not rm.is_auth():
-        if args.remarkable_relogin_command:
-            subprocess.run(['/bin/bash', '-c', args.remarkable_relogin_command])
-
-    ls = []
-    try:
-        ls = rm.ls(args.folder)
-    except FileNotFoundError:
-        rm.mkdir(args.folder)
-        ls = []
-    
+def ensure_config_folder(args):
     if not args.config_folder:
         args.config_folder = os.path.join(os.path.expanduser('~'), '.config', 'remarkable-substack')
         if not os.path.exists(args.config_folder):
             os.makedirs(args.config_folder)
         print(f'Set --config-folder to {args.config_folder}')
-    
-    print(f'Existing files in {args.folder}: {ls}')
-    
-    db_file = os.path.join(args.config_folder, 'db_file.json')
-    already_downloaded_ids = set()
-    article_data = {}
-    if os.path.exists(db_file):
-        article_data = json.loads(open(db_file, 'r').read())
-    
-    already_downloaded_ids = list(article_data.keys())
+
+class Session:
+    """The connections a sync works through, which --daemon keeps open between
+    syncs: the rmapi shell, the article store, the Substack API session, and the
+    render browsers and upload threads once they have been started.
+
+    With --accounts, each account has a Session of its own, whose renders go
+    to the RenderPool shared by every account as the given account, and whose
+    requests go through the RateLimiter shared by every account. Metrics are
+    then configured once for the process, rather than by each Session.
+    """
+    def __init__(self, args, pool=None, account=None, limiter=None):
+        ensure_config_folder(args)
+        self.shared = pool is not None
+        self.account = account
+        self.rss = None
+        if not self.shared:
+            metrics.configure(os.path.join(args.config_folder, args.metrics_file) if args.metrics_file else None,
+                              os.path.join(args.config_folder, 'metrics.prom') if args.prometheus_textfile else None)
+            self.rss = RssSampler()
+            self.rss.start()
+
+        try:
+            self.rm = Remarkable(persistent=not args.rmapi_one_shot, config=args.rmapi_config)
+            self.rm.auth_if_needed(args.remarkable_auth_token)
+        except Exception as e:
+            if args.remarkable_relogin_command:
+                subprocess.run(['/bin/bash', '-c', args.remarkable_relogin_command])
+            raise e
+
+        if not self.rm.is_auth():
+            if args.remarkable_relogin_command:
+                subprocess.run(['/bin/bash', '-c', args.remarkable_relogin_command])
+
+        self.store = ArticleStore(os.path.join(args.config_folder, 'articles.db'))
+        self.store.migrate_json(os.path.join(args.config_folder, 'db_file.json'))
+
+        # The API is read with the saved cookies alone. A browser is only
+        # launched to log in or to refresh cookies which are about to expire;
+        # articles are rendered by the RenderPool workers.
+        self.cookie_file = os.path.join(args.config_folder, '.substack-cookie')
+        self.limiter = limiter or RateLimiter(args.rate_limit, burst=args.rate_burst, max_retries=args.max_429_retries)
+        self.ss = Substack(None, cookie_file=self.cookie_file, refresh_cookies=False, limiter=self.limiter,
+                           http_cache=HttpCache(os.path.join(args.config_folder, 'http-cache')),
+                           subscriptions_ttl=args.subscriptions_cache_hours * 60 * 60)
+        self.login_url = args.substack_login_url
+
+        login_check_interval = args.login_check_minutes * 60 if args.login_check_minutes is not None else None
+        if login_check_interval is None and args.daemon:
+            # "Once per run" means once per sync when the browsers are kept between syncs
+            login_check_interval = args.poll_minutes * 60
+        render_kwargs = dict(limiter=self.limiter, login_check_interval=login_check_interval,
+                             render_timeout=args.render_timeout, report_wait_time=args.report_wait_time,
+                             lazy_load_mode=args.lazy_load_mode, device=args.device,
+                             recycle_page_after=args.recycle_page_after, recycle_context_mb=args.recycle_context_mb,
+                             request_filter=None if args.no_request_filter else RequestFilter.load(os.path.join(args.config_folder, 'request-filter.json')))
+        if self.shared:
+            self.pool = pool
+            self.pool.add_account(account, self.cookie_file, **render_kwargs)
+        else:
+            self.pool = RenderPool(args.render_concurrency, self.cookie_file, headless=not args.non_headless, slow_mo=args.slow_mo,
+                                   postprocess_workers=args.postprocess_workers, strip_metadata=args.strip_pdf_metadata,
+                                   **render_kwargs)
+        self.uploader = ThreadPoolExecutor(max_workers=max(1, args.upload_concurrency))
+
+    def close(self, cancel=False):
+        if not self.shared:
+            self.pool.close(cancel=cancel)
+        self.uploader.shutdown(cancel_futures=True)
+        self.store.close()
+        self.rm.close()
+        if not self.shared:
+            self.rss.stop()
+            metrics.close()
+
+def main(args, session=None):
+    """Runs one sync. Connections are reused from session if one is given, and then left open."""
+    metrics.lap('run_stage_seconds')
+    owned = session is None
+    if owned:
+        session = Session(args)
+    rm, store, ss, pool, uploader = session.rm, session.store, session.ss, session.pool, session.uploader
+    if not owned:
+        rm.refresh()
+
+    journal = Journal(os.path.join(args.config_folder, 'journal.jsonl'))
+    cursor_file = os.path.join(args.config_folder, 'feed_cursor.json')
+    cursor = None
+    if os.path.exists(cursor_file) and not args.full_rescan:
+        cursor = json.loads(open(cursor_file, 'r').read()).get('post_date')
+        print(f'Fetching posts newer than {cursor}')
 
     existing_ids = set()
-    files_to_delete = set()
-    delete_if_needed = {}
-    now_ts = time.time()
-    for file in ls:
-        id = parse_filename(file)
-        if id:
-            existing_ids.add(id)
-            if id in article_data:
-                added_ts = article_data.get(id)['added']
-                num_pages = article_data.get(id)['num_pages']
-                stat = rm.stat(f'{args.folder}/{file}')
-                print(f"Check: {file} is on page {1+stat['CurrentPage']} of {num_pages} total")
-                if args.delete_already_read and 1 + stat['CurrentPage'] == num_pages:
-                    print(f"Will delete {file} since already read")
-                    files_to_delete.add(f'{args.folder}/{file}')
-                else:
-                    unread_hrs = (now_ts - added_ts) / 60 / 60
-                    if args.delete_unread_after_hours >= 0 and unread_hrs >= args.delete_unread_after_hours:
-                        print(f"Article not opened after {unread_hrs} hrs, will delete if needed: {file}")
-                        delete_if_needed[id] = f'{args.folder}/{file}'
+    all_posts = []
+    renders = {}
+    uploads = {}
+    completed = False
+    # Whatever fails, e.g. expired cookies or rmapi, the journal is closed and
+    # the cursor and metrics are saved, which --daemon relies on between polls
+    try:
+        ls = []
+        try:
+            ls = rm.ls(args.folder)
+        except FileNotFoundError:
+            rm.mkdir(args.folder)
+            ls = []
+    
+        print(f'Existing files in {args.folder}: {ls}')
+
+        resume_from_journal(journal, store)
+        metrics.lap('run_stage_seconds', 'setup')
+
+        files_to_delete = set()
+        delete_if_needed = {}
+        now_ts = time.time()
+        snapshot = rm.snapshot(args.folder, [f for f in ls if parse_filename(f) in store])
+        for file in ls:
+            id = parse_filename(file)
+            if id:
+                existing_ids.add(id)
+                article = store.get(id)
+                if article:
+                    added_ts = article['added']
+                    num_pages = article['num_pages']
+                    stat = snapshot.get(file) or rm.stat(f'{args.folder}/{file}')
+                    store.update_progress(id, stat['CurrentPage'], now_ts)
+                    print(f"Check: {file} is on page {1+stat['CurrentPage']} of {num_pages} total")
+                    if args.delete_already_read and 1 + stat['CurrentPage'] == num_pages:
+                        print(f"Will delete {file} since already read")
+                        files_to_delete.add(f'{args.folder}/{file}')
+                    else:
+                        unread_hrs = (now_ts - added_ts) / 60 / 60
+                        if args.delete_unread_after_hours >= 0 and unread_hrs >= args.delete_unread_after_hours:
+                            print(f"Article not opened after {unread_hrs} hrs, will delete if needed: {file}")
+                            delete_if_needed[id] = f'{args.folder}/{file}'
     
-    print(f'{existing_ids=}')
-    print(f'{delete_if_needed.keys()=}')
-    if args.delete_already_read:
-        print(f'{files_to_delete=}')
-
-        if len(files_to_delete) > 0:
-            print('Deleting old files')
-            for path in files_to_delete:
-                print(f'Deleting {path}')
-                assert path.startswith(f'{args.folder}/')
-                assert '../' not in path
-                assert '/..' not in path
-                assert len(path) > 2 + len(args.folder)
-                rm.rm(path)
-
-                id = parse_filename(path)
-                if id and id in article_data:
-                    article_data[id]['deleted'] = now_ts
-            files_to_delete = []
-
-
-    with Stealth().use_sync(sync_playwright()) as p:
-        chromium = p.chromium
-        browser = chromium.launch(headless=not args.non_headless, slow_mo=args.slow_mo)
-        context = browser.new_context(
-            viewport={'width': 1920, 'height': 1080},
-            user_agent='Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36',
-            locale='en-US',
-            timezone_id='America/New_York',
-        )
-
-        cookie_file = os.path.join(args.config_folder, '.substack-cookie')
+        print(f'{existing_ids=}')
+        print(f'{delete_if_needed.keys()=}')
+        if args.delete_already_read:
+            print(f'{files_to_delete=}')
+
+            if len(files_to_delete) > 0:
+                delete_files(rm, args.folder, files_to_delete, store, journal, now_ts)
+                files_to_delete = []
+        metrics.lap('run_stage_seconds', 'snapshot')
+
         try:
-            ss = Substack(context, cookie_file=cookie_file, login_url=args.substack_login_url)
+            if session.login_url:
+                print('Using Substack login_url')
+                try:
+                    ss.refresh_in_browser(session.login_url, headless=not args.non_headless, slow_mo=args.slow_mo)
+                except Exception as e:
+                    print('login failed, trying to read existing cookies', e)
+                # The link from the login email can only be used once
+                session.login_url = None
+            elif ss.cookies_expire_within(args.cookie_refresh_hours * 60 * 60):
+                print('Substack cookies are missing or about to expire, refreshing them')
+                ss.refresh_in_browser(headless=not args.non_headless, slow_mo=args.slow_mo)
             subs = ss.get_subscriptions()
+            # The subscriptions may come from the cache, so the first page of the
+            # inbox is what finds out the session is no longer logged in
+            print('get_posts(after=None)')
+            first_posts = ss.get_posts(limit=20)
         except Exception as e:
             if args.relogin_command:
                 subprocess.run(['/bin/bash', '-c', args.relogin_command])
             raise e
+        metrics.lap('run_stage_seconds', 'subscriptions')
+
         publications = {}
         for pub in subs['publications']:
             publications[pub['id']] = pub['name']
 
+        def publication_name(pub_id):
+            if pub_id not in publications:
+                # Subscribed to since the cached subscriptions were fetched
+                print(f'Unknown publication {pub_id}, refreshing subscriptions')
+                for pub in ss.get_subscriptions(refresh=True)['publications']:
+                    publications[pub['id']] = pub['name']
+                publications.setdefault(pub_id, f'Publication {pub_id}')
+            return publications[pub_id]
+
         def to_filename(post):
-            pub_name = publications[post['publication_id']]
+            pub_name = publication_name(post['publication_id'])
             title = post['title']
             return f"{pub_name} - {title} [{id}].pdf"
 
@@ -151,106 +278,347 @@ def main(args):
         new_ids = set()
         fetched_ids = set()
         fetched_old_ids = set()
-        all_posts = []
         after = None
+        reached_cursor = False
         while len(fetched_ids) < args.max_fetch_count:
-            print(f'get_posts(after={after})')
-            posts = ss.get_posts(limit=20, after=after)
+            if after is None:
+                posts = first_posts
+            else:
+                print(f'get_posts(after={after})')
+                posts = ss.get_posts(limit=20, after=after)
 
             for post in posts['posts']:
+                if cursor and post['post_date'] <= cursor:
+                    print(f"Reached already seen post from {post['post_date']} -- stopping")
+                    reached_cursor = True
+                    break
                 id = str(post['id'])
                 fetched_ids.add(id)
                 if id not in existing_ids:
-                    if id not in already_downloaded_ids:
+                    if id not in store:
                         if len(new_ids) + len(existing_ids) < args.max_save_count:
                             print(f'Found new article: {id}: {to_filename(post)}')
                             new_ids.add(id)
+                            journal.record(id, 'discovered', canonical_url=post['canonical_url'], filename=to_filename(post))
                         elif len(delete_if_needed) > 0 and args.delete_unread_after_hours >= 0:
-                            delete_id = list(sorted(list(delete_if_needed.keys())))[0]
+                            delete_id = store.oldest_unread_on_device(delete_if_needed.keys()) or sorted(delete_if_needed.keys())[0]
                             print(f'Article in delete_if_needed dropped: {delete_id} {delete_if_needed[delete_id]}')
                             files_to_delete.add(delete_if_needed[delete_id])
                             del delete_if_needed[delete_id]
 
                             print(f'Found new article: {id}: {to_filename(post)}')
                             new_ids.add(id)
+                            journal.record(id, 'discovered', canonical_url=post['canonical_url'], filename=to_filename(post))
                         else:
                             print(f'Found but not downloading new article (no space): {id}: {to_filename(post)}')
                     else:
                         print(f'Article already read: {id}: {to_filename(post)}')
-                    
+                
                 else:
                     fetched_old_ids.add(id)
                     print(f'Article already on remarkable: {id}: {to_filename(post)}')
                 after = post['post_date']
                 all_posts.append(post)
 
+            if reached_cursor:
+                break
             if not posts['more']:
                 print('No more posts to return -- stopping')
                 break
-            
-            time.sleep(5)
-        
+    
         print(f'{fetched_ids=}')
         print(f'{fetched_old_ids=}')
         print(f'{new_ids=}')
+        metrics.lap('run_stage_seconds', 'fetch')
 
         dir = tempfile.gettempdir()
         if args.tmp_folder:
             dir = args.tmp_folder
-        to_upload = []
+        failed_uploads = {}
+        render_cache = None
+        if args.render_cache_mb > 0:
+            render_cache = RenderCache(os.path.join(args.config_folder, 'render-cache'), args.render_cache_mb * 1024 * 1024)
+
+        def upload(info, output_file):
+            upload_file(rm, output_file, args.folder, args.upload_retries)
+            journal.record(info['id'], 'uploaded', **info)
+
         for post in all_posts:
             id = str(post['id'])
             if id in new_ids:
                 output_file = os.path.join(dir, to_filename(post))
-                print(f"Downloading {post['canonical_url']} to pdf {output_file}")
-                ss.download_pdf(post['canonical_url'], output_file)
-                if not os.path.exists(output_file):
-                    print(f"Unable to download {post['canonical_url']} to {output_file}. Skipping")
-                    time.sleep(5)
-                    continue
-                num_pages = get_num_pages(output_file)
-                article_data[id] = {
-                    'id': id,
-                    'num_pages': num_pages,
-                    'canonical_url': post['canonical_url'],
-                    'filename': to_filename(post),
-                    'added': now_ts
-                }
-                to_upload.append(output_file)
-                print(f"Download complete: {article_data[id]}")
-                time.sleep(5)
-
-        
-        print(f'Uploading: {to_upload}')
-        for f in to_upload:
-            print(f'Uploading {f} to {args.folder}')
-            rm.put(f, args.folder)
-
-        print('Upload complete')
+                cache_key = RenderCache.key(id, post_revision(post), args.device)
+                if journal_rendered_file(journal, id, output_file):
+                    print(f"Resuming: reusing {output_file} rendered by an interrupted run")
+                    fut = completed_future(True)
+                elif render_cache and render_cache.get(cache_key, output_file):
+                    print(f"Using cached render of {post['canonical_url']} for {output_file}")
+                    fut = completed_future(True)
+                    cache_key = None
+                else:
+                    html = None
+                    if args.renderer == 'html':
+                        html = fetch_article_html(ss, post['canonical_url'], args.device)
+                    print(f"Downloading {post['canonical_url']} to pdf {output_file}")
+                    fut = pool.submit(post['canonical_url'], output_file, html=html, expected_words=post.get('wordcount'), account=session.account)
+                renders[fut] = (id, post, output_file, cache_key)
+
+        # Upload each article as soon as it has rendered, while the rest keep rendering
+        for fut in as_completed(renders):
+            id, post, output_file, cache_key = renders[fut]
+            rendered = None
+            try:
+                rendered = fut.result()
+            except Exception as e:
+                print(f"Error downloading {post['canonical_url']}: {e}")
+            # A rejected render leaves behind whatever was at output_file before
+            if not rendered or not os.path.exists(output_file):
+                print(f"Unable to download {post['canonical_url']} to {output_file}. Skipping")
+                continue
+            if rendered and render_cache and cache_key:
+                render_cache.put(cache_key, output_file)
+            if not isinstance(rendered, dict):
+                # Resumed or cached, so only on disk
+                with open(output_file, 'rb') as f:
+                    rendered = pdf_info(f.read())
+            num_pages = rendered['num_pages']
+            info = {
+                'id': id,
+                'publication_id': post['publication_id'],
+                'post_date': post['post_date'],
+                'num_pages': num_pages,
+                'canonical_url': post['canonical_url'],
+                'filename': to_filename(post),
+                'added': now_ts
+            }
+            journal.record(id, 'rendered', path=output_file, sha256=rendered['sha256'], num_pages=num_pages)
+            print(f"Download complete: {info}")
+            print(f'Uploading {output_file} to {args.folder}')
+            uploads[uploader.submit(upload, info, output_file)] = info
+
+        for fut in as_completed(uploads):
+            info = uploads[fut]
+            try:
+                fut.result()
+                store.add(info)
+            except Exception as e:
+                # The article isn't saved, so that it is downloaded again on the next run
+                failed_uploads[info['id']] = info['filename']
+                print(f"Upload of {info['filename']} failed: {e}")
+
+        print(f'Upload complete: {len(uploads) - len(failed_uploads)} uploaded, {len(failed_uploads)} failed')
+        if failed_uploads:
+            print(f'{failed_uploads=}')
+        metrics.lap('run_stage_seconds', 'render_upload')
+        metrics.inc('articles_total', len(uploads) - len(failed_uploads), result='uploaded')
+        metrics.inc('articles_total', len(failed_uploads), result='failed')
 
 
         if args.delete_already_read and len(files_to_delete) > 0:
-            print('Deleting old files')
-            for path in files_to_delete:
-                print(f'Deleting {path}')
-                assert path.startswith(f'{args.folder}/')
-                assert '../' not in path
-                assert '/..' not in path
-                assert len(path) > 2 + len(args.folder)
-                rm.rm(path)
-
-                id = parse_filename(path)
-                if id and id in article_data:
-                    article_data[id]['deleted'] = now_ts
-        
-        with open(db_file, 'w') as f:
-            f.write(json.dumps(article_data))
-
-def get_num_pages(path):
-    with open(path, 'rb') as f:
-        r = pypdf.PdfReader(f)
-        return len(r.pages)
+            delete_files(rm, args.folder, files_to_delete, store, journal, now_ts)
+        metrics.lap('run_stage_seconds', 'delete')
+        completed = True
+    finally:
+        # On an interrupted run, drop the queued renders and uploads, and only
+        # wait for the uploads already in progress
+        for fut in list(renders) + list(uploads):
+            fut.cancel()
+        wait(uploads)
+
+        # Everything in the article store no longer needs the journal, but keep
+        # uploads it is missing and rendered PDFs which can still be reused
+        journal.compact(lambda id, e: id not in store and ('uploaded' in e['stages'] or journal_rendered_file(journal, id, e.get('path'))))
+        journal.close()
+
+        new_cursor = next_feed_cursor(all_posts, store, existing_ids, cursor)
+        if new_cursor != cursor:
+            print(f'Saving feed cursor {new_cursor}')
+            with open(cursor_file, 'w') as f:
+                f.write(json.dumps({'post_date': new_cursor}))
+
+        # With --accounts, the totals cover every account, so run_accounts()
+        # reports them once all the accounts have synced
+        if not session.shared:
+            session.rss.report()
+            print(f'Metrics:\n{metrics.summary()}')
+            metrics.write_textfile()
+        if owned:
+            session.close(cancel=not completed)
+
+def daemon(args):
+    """Syncs every --poll-minutes, keeping the connections in a Session open in between."""
+    session = Session(args)
+    try:
+        while True:
+            try:
+                main(args, session)
+            except Exception as e:
+                print(f'Sync failed, retrying at the next poll: {e}')
+                traceback.print_exc()
+            delay = 60 * (args.poll_minutes + random.uniform(0, args.poll_jitter_minutes))
+            print(f'Next sync in {delay / 60:.1f} minutes')
+            time.sleep(delay)
+    finally:
+        session.close(cancel=True)
+
+# Options which apply to the whole process with --accounts, so can't be set per account
+PROCESS_OPTIONS = {'accounts', 'daemon', 'poll_minutes', 'poll_jitter_minutes', 'render_concurrency', 'non_headless',
+                   'slow_mo', 'postprocess_workers', 'strip_pdf_metadata', 'metrics_file', 'prometheus_textfile',
+                   'rate_limit', 'rate_burst', 'max_429_retries'}
+
+def load_accounts(args):
+    """Returns each account in --accounts by name, with the command line's options overridden by its own."""
+    with open(args.accounts, 'r') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f'{args.accounts} should be a JSON list of at least one account')
+    accounts = {}
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError(f'Account {i + 1} in {args.accounts} should be a JSON object, not {entry!r}')
+        entry = {k.replace('-', '_'): v for k, v in entry.items()}
+        name = entry.pop('name', None)
+        if not name:
+            raise ValueError(f'Account {i + 1} in {args.accounts} has no name')
+        if name in accounts:
+            raise ValueError(f'Account {name} appears more than once in {args.accounts}')
+        if not entry.get('config_folder'):
+            raise ValueError(f'Account {name} in {args.accounts} has no config_folder')
+        for key in entry:
+            if key not in vars(args) or key in PROCESS_OPTIONS:
+                raise ValueError(f"Account {name} in {args.accounts} sets {key}, which isn't a per-account option")
+        account_args = argparse.Namespace(**{**vars(args), **entry})
+        if 'tmp_folder' not in entry:
+            # Accounts subscribed to the same publication would render to the same file names
+            account_args.tmp_folder = os.path.join(args.tmp_folder or tempfile.gettempdir(), f'remarkable-substack-{name}')
+        os.makedirs(account_args.tmp_folder, exist_ok=True)
+        accounts[name] = account_args
+    return accounts
+
+def run_accounts(args):
+    """Syncs every account in --accounts, once, or every --poll-minutes with --daemon.
+
+    Accounts sync concurrently, each in a Session of its own, but share one
+    RenderPool: a browser per render worker rather than per account, holding
+    a separate context for each account, and taking their renders in turn.
+    They also share one RateLimiter, as they all make their requests to the
+    same Substack hosts.
+    """
+    accounts = load_accounts(args)
+    ensure_config_folder(args)
+    metrics.configure(os.path.join(args.config_folder, args.metrics_file) if args.metrics_file else None,
+                      os.path.join(args.config_folder, 'metrics.prom') if args.prometheus_textfile else None)
+    rss = RssSampler()
+    rss.start()
+    pool = RenderPool(args.render_concurrency, headless=not args.non_headless, slow_mo=args.slow_mo,
+                      postprocess_workers=args.postprocess_workers, strip_metadata=args.strip_pdf_metadata)
+    limiter = RateLimiter(args.rate_limit, burst=args.rate_burst, max_retries=args.max_429_retries)
+    sessions = {}
+
+    def sync(name):
+        try:
+            if name not in sessions:
+                sessions[name] = Session(accounts[name], pool, account=name, limiter=limiter)
+            main(accounts[name], sessions[name])
+        except SystemExit as e:
+            # e.g. an account which isn't authenticated with reMarkable, which
+            # mustn't stop the others
+            raise RuntimeError(f'exited with code {e.code}')
+
+    executor = ThreadPoolExecutor(max_workers=len(accounts), thread_name_prefix='account')
+    completed = False
+    try:
+        while True:
+            syncs = {executor.submit(sync, name): name for name in accounts}
+            for fut in as_completed(syncs):
+                try:
+                    fut.result()
+                except Exception as e:
+                    print(f'Sync of account {syncs[fut]} failed: {e}')
+                    traceback.print_exception(e)
+            rss.report()
+            print(f'Metrics:\n{metrics.summary()}')
+            metrics.write_textfile()
+            if not args.daemon:
+                break
+            delay = 60 * (args.poll_minutes + random.uniform(0, args.poll_jitter_minutes))
+            print(f'Next sync in {delay / 60:.1f} minutes')
+            time.sleep(delay)
+        completed = True
+    finally:
+        # Drop the queued renders first, so that interrupted syncs can finish
+        # and save their progress
+        pool.close(cancel=not completed)
+        executor.shutdown()
+        for session in sessions.values():
+            session.close(cancel=not completed)
+        rss.stop()
+        metrics.close()
+
+def completed_future(result):
+    fut = Future()
+    fut.set_result(result)
+    return fut
+
+def delete_files(rm, folder, files_to_delete, store, journal, now_ts):
+    print('Deleting old files')
+    for path in files_to_delete:
+        print(f'Deleting {path}')
+        assert path.startswith(f'{folder}/')
+        assert '../' not in path
+        assert '/..' not in path
+        assert len(path) > 2 + len(folder)
+        rm.rm(path)
+
+        id = parse_filename(path)
+        if id:
+            journal.record(id, 'deleted', path=path, deleted=now_ts)
+            store.mark_deleted(id, now_ts)
+
+def resume_from_journal(journal, store):
+    for id, entry in journal.entries.items():
+        if 'uploaded' in entry['stages'] and id not in store:
+            print(f"Resuming: {entry['filename']} was uploaded by an interrupted run")
+            store.add(entry)
+        if 'deleted' in entry['stages']:
+            store.mark_deleted(id, entry['deleted'])
+
+def journal_rendered_file(journal, id, path):
+    entry = journal.get(id)
+    if not path or not journal.has(id, 'rendered') or entry.get('path') != path:
+        return False
+    return os.path.exists(path) and file_checksum(path) == entry['sha256']
+
+def next_feed_cursor(posts, store, existing_ids, cursor):
+    # Posts that weren't saved this run (no space on the device, or a failed
+    # render or upload) must stay newer than the cursor so they are fetched again
+    pending = [p['post_date'] for p in posts if str(p['id']) not in store and str(p['id']) not in existing_ids]
+    done = [p['post_date'] for p in posts if not pending or p['post_date'] < min(pending)]
+    if not done:
+        return cursor
+    return max(done + ([cursor] if cursor else []))
+
+def upload_file(rm, path, folder, retries):
+    for attempt in range(retries + 1):
+        try:
+            return rm.put(path, folder)
+        except RuntimeError as e:
+            # A retry after a put that actually went through finds the document already there
+            if attempt > 0 and 'already exists' in str(e):
+                return True
+            if attempt == retries:
+                raise
+            delay = 5 * 2 ** attempt
+            print(f'Upload of {path} failed, retrying in {delay}s: {e}')
+            time.sleep(delay)
 
 if __name__ == '__main__':
+    # Let the finally blocks save progress when the scheduler stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
     args = parse_args()
-    main(args)
\ No newline at end of file
+    if args.accounts:
+        run_accounts(args)
+    elif args.daemon:
+        daemon(args)
+    else:
+        main(args)
\ No newline at end of file
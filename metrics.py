@@ -0,0 +1,219 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+class Metrics:
+    """Timings and counters for a sync run.
+
+    Every observation is appended to a JSON lines file as it happens, and
+    totals are kept per metric and label set for summary() and for an
+    optional Prometheus textfile, written by write_textfile().
+    """
+    def __init__(self):
+        self.f = None
+        self.path = None
+        self.max_bytes = None
+        self.textfile = None
+        self.run_id = None
+        self.totals = {}
+        self.laps = {}
+        self.lock = threading.Lock()
+
+    def configure(self, path=None, textfile=None, max_bytes=10*1024*1024):
+        self.run_id = int(time.time())
+        self.path = path
+        self.max_bytes = max_bytes
+        if path:
+            if os.path.exists(path) and os.path.getsize(path) > max_bytes:
+                os.replace(path, f'{path}.1')
+            self.f = open(path, 'a')
+        self.textfile = textfile
+
+    def _rotate_if_needed(self):
+        # Checked as the file is written, as --daemon never starts over
+        if self.f.tell() > self.max_bytes:
+            self.f.close()
+            os.replace(self.path, f'{self.path}.1')
+            self.f = open(self.path, 'a')
+
+    def _emit(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            total = self.totals.setdefault(key, {'kind': kind, 'count': 0, 'sum': 0, 'max': 0})
+            total['count'] += 1
+            total['sum'] += value
+            total['max'] = max(total['max'], value)
+            if self.f:
+                self.f.write(json.dumps({'ts': time.time(), 'run': self.run_id, 'name': name, 'value': value, **labels}) + '\n')
+                self.f.flush()
+                self._rotate_if_needed()
+
+    def observe(self, name, value, **labels):
+        self._emit('summary', name, value, labels)
+
+    def inc(self, name, value=1, **labels):
+        self._emit('counter', name, value, labels)
+
+    def gauge(self, name, value, **labels):
+        self._emit('gauge', name, value, labels)
+
+    def lap(self, name, stage=None):
+        """Records the time since the previous lap of name as stage, or only starts timing the next lap if stage is None.
+
+        Laps are kept per thread, so concurrent syncs each time their own stages.
+        """
+        now = time.monotonic()
+        key = (threading.get_ident(), name)
+        last = self.laps.get(key)
+        self.laps[key] = now
+        if stage and last is not None:
+            self.observe(name, now - last, stage=stage)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def summary(self):
+        lines = []
+        with self.lock:
+            for (name, labels), t in sorted(self.totals.items()):
+                label_str = ','.join(f'{k}={v}' for k, v in labels)
+                if t['kind'] == 'summary':
+                    lines.append(f'{name}{{{label_str}}} count={t["count"]} sum={t["sum"]:.2f} max={t["max"]:.2f}')
+                elif t['kind'] == 'counter':
+                    lines.append(f'{name}{{{label_str}}} {t["sum"]}')
+                else:
+                    lines.append(f'{name}{{{label_str}}} max={t["max"]}')
+        return '\n'.join(lines)
+
+    def write_textfile(self):
+        if not self.textfile:
+            return
+        lines = []
+        types = {}
+        with self.lock:
+            for (name, labels), t in sorted(self.totals.items()):
+                metric = f'remarkable_substack_{name}'
+                label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+                if t['kind'] == 'summary':
+                    types[metric] = 'summary'
+                    lines.append(f'{metric}_count{{{label_str}}} {t["count"]}')
+                    lines.append(f'{metric}_sum{{{label_str}}} {t["sum"]}')
+                elif t['kind'] == 'counter':
+                    types[metric] = 'counter'
+                    lines.append(f'{metric}{{{label_str}}} {t["sum"]}')
+                else:
+                    types[metric] = 'gauge'
+                    lines.append(f'{metric}{{{label_str}}} {t["max"]}')
+        lines = [f'# TYPE {m} {kind}' for m, kind in sorted(types.items())] + lines
+        lines.append(f'remarkable_substack_last_run_timestamp_seconds {time.time()}')
+        # Written atomically, as the node exporter may read it at any moment
+        tmp = f'{self.textfile}.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.textfile)
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+# Process names of the Playwright driver (node) and Chromium
+BROWSER_PROCESSES = ('node', 'chrome', 'chromium', 'headless_shell')
+
+def _descendants(pid):
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'r') as f:
+                # the command name is in parentheses and may contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    found = []
+    stack = [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            found.append(child)
+            stack.append(child)
+    return found
+
+def _rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def _pss_bytes(pid):
+    """Proportional set size: shared pages are split between the processes
+    sharing them, so the sizes of a process tree add up without counting the
+    browser's shared memory once per process. Falls back to the RSS on kernels
+    without smaps_rollup."""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return _rss_bytes(pid)
+
+def process_tree_bytes(pid):
+    """Returns the memory (PSS) of pid and all of its descendants."""
+    if not os.path.exists('/proc'):
+        return 0
+    return sum(_pss_bytes(p) for p in [pid] + _descendants(pid))
+
+def _comm(pid):
+    try:
+        with open(f'/proc/{pid}/comm', 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+def browser_rss_bytes():
+    """Returns the resident memory of the Playwright driver and browsers started by this process."""
+    if not os.path.exists('/proc'):
+        return 0
+    return sum(_rss_bytes(pid) for pid in _descendants(os.getpid())
+               if _comm(pid).startswith(BROWSER_PROCESSES))
+
+class RssSampler:
+    """Samples browser_rss_bytes() on a background thread, keeping the peak."""
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, browser_rss_bytes())
+
+    def start(self):
+        self.thread.start()
+
+    def report(self):
+        """Records the peak since the last report."""
+        metrics.gauge('browser_rss_peak_bytes', self.peak)
+        self.peak = 0
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+# Shared by every module, and only written out once main() configures it
+metrics = Metrics()
@@ -0,0 +1,194 @@
+import hashlib
+import io
+import os
+import re
+import time
+
+import pypdf
+
+from metrics import metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Page geometry for each device we render for. 'pixels' is the screen
+# resolution, which no embedded image needs to exceed.
+DEVICE_PROFILES = {
+    'a4': {
+        'size': 'A4',
+        'margin': '20mm',
+        'body_width': '250mm',
+        'pixels': None,
+        'grayscale': False,
+    },
+    'rm2': {
+        'size': '157.8mm 210.4mm',
+        'margin': '8mm',
+        'body_width': None,
+        'pixels': (1404, 1872),
+        'grayscale': True,
+    },
+    'paperpro': {
+        'size': '179.6mm 239.6mm',
+        'margin': '8mm',
+        'body_width': None,
+        'pixels': (1620, 2160),
+        'grayscale': False,
+    },
+}
+
+def page_css(device):
+    """Returns the stylesheet to print an article page for device."""
+    profile = DEVICE_PROFILES[device]
+    def page(indent):
+        return f'''{indent}@page {{
+{indent}    size: {profile['size']};
+{indent}    margin: {profile['margin']} !important;
+{indent}}}'''
+    body_width = ''
+    if profile['body_width']:
+        body_width = f'''
+
+    html, body {{
+        width: {profile['body_width']};
+    }}'''
+    return f'''
+{page('')}
+@media all {{
+{page('    ')}
+
+    article {{
+        margin: 0 {profile['margin']} !important;
+    }}
+
+    div#discussion, .publication-footer, .footer {{
+        display: none !important;
+    }}{body_width}
+}}
+'''
+
+def _shrink_image(image, profile):
+    pil = image.image
+    if 'A' in pil.mode or 'transparency' in pil.info:
+        # Leave images with transparency alone, their soft mask is stored separately
+        return False
+    changed = False
+    w, h = profile['pixels']
+    if pil.width > w or pil.height > h:
+        pil.thumbnail((w, h))
+        changed = True
+    if profile['grayscale'] and pil.mode not in ('L', '1'):
+        pil = pil.convert('L')
+        changed = True
+    if changed:
+        image.replace(pil, quality=75)
+    return changed
+
+def optimize_pdf(writer, device, name=''):
+    """Shrinks a rendered PDF for device, in place: images are downsampled to
+    the screen resolution (and made grayscale, on grayscale devices) if Pillow
+    is installed, and streams and duplicate objects are compressed.
+
+    Returns the number of images shrunk.
+    """
+    profile = DEVICE_PROFILES[device]
+    shrunk = 0
+    for page in writer.pages:
+        if profile['pixels'] and Image:
+            for image in page.images:
+                try:
+                    shrunk += _shrink_image(image, profile)
+                except Exception as e:
+                    print(f'Unable to shrink image {image.name} in {name}: {e}')
+        page.compress_content_streams()
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    return shrunk
+
+# Shown in place of the rest of an article which the session can't read
+PAYWALL_TEXT_RE = re.compile(r'This post is for paid subscribers|This post is for paying subscribers|'
+                             r'Keep reading with a 7-day free trial|Subscribe to keep reading', re.IGNORECASE)
+# A render with less text than this, and no images, printed before the article loaded
+MIN_TEXT_CHARS = 200
+# A render with fewer words than this fraction of the post's wordcount was cut off
+MIN_WORDS_FRACTION = 0.5
+
+class InvalidPdf(Exception):
+    """A render which shouldn't be uploaded, with the reason as its message."""
+
+def check_pdf(writer, expected_words=None):
+    """Raises InvalidPdf if the render is blank, or stops at a paywall or short of expected_words."""
+    text = ' '.join(' '.join(page.extract_text() or '' for page in writer.pages).split())
+    if PAYWALL_TEXT_RE.search(text):
+        raise InvalidPdf('paywall')
+    if len(text) < MIN_TEXT_CHARS and not any(page.images for page in writer.pages):
+        raise InvalidPdf('blank')
+    words = len(text.split())
+    if expected_words and words < expected_words * MIN_WORDS_FRACTION:
+        raise InvalidPdf('truncated')
+
+def postprocess_pdf(data, output_file, device, expected_words=None, strip_metadata=False):
+    """Checks and optimizes a PDF printed by a renderer, and writes it to
+    output_file for the upload.
+
+    Runs in the RenderPool's worker processes, which don't record metrics, so
+    returns what record_postprocess() needs along with the pdf_info(). Raises
+    InvalidPdf, without writing anything, if check_pdf() fails.
+    """
+    start = time.monotonic()
+    writer = pypdf.PdfWriter(clone_from=io.BytesIO(data))
+    check_pdf(writer, expected_words)
+    shrunk = optimize_pdf(writer, device, output_file)
+    if strip_metadata:
+        writer.metadata = None
+        writer.root_object.pop('/Metadata', None)
+    num_pages = len(writer.pages)
+
+    out = io.BytesIO()
+    writer.write(out)
+    optimized = out.getvalue()
+    rendered_size = len(data)
+    if len(optimized) < rendered_size or strip_metadata:
+        print(f'Optimized {output_file} for {device}: {rendered_size} -> {len(optimized)} bytes, {shrunk} images shrunk')
+        data = optimized
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with open(output_file, 'wb') as f:
+        f.write(data)
+    return {**pdf_info(data, num_pages), 'rendered_size': rendered_size, 'seconds': time.monotonic() - start}
+
+def record_postprocess(info):
+    metrics.observe('pdf_bytes', info['rendered_size'], stage='rendered')
+    metrics.observe('pdf_bytes', info['size'], stage='optimized')
+    metrics.observe('render_stage_seconds', info['seconds'], stage='postprocess')
+
+_ROOT_RE = re.compile(rb'/Root\s+(\d+)\s+(\d+)\s+R')
+_PAGES_RE = re.compile(rb'/Pages\s+(\d+)\s+(\d+)\s+R')
+_COUNT_RE = re.compile(rb'/Count\s+(\d+)')
+
+def _object(data, ref):
+    m = re.search(rb'(?<!\d)' + ref[0] + rb'\s+' + ref[1] + rb'\s+obj\b', data)
+    if not m:
+        return None
+    end = data.find(b'endobj', m.end())
+    return data[m.end():end] if end != -1 else None
+
+def count_pages(data):
+    """Returns the page count of a PDF, read from the /Count of the root of its
+    page tree instead of parsing the whole document where possible."""
+    roots = _ROOT_RE.findall(data)
+    catalog = _object(data, roots[-1]) if roots else None
+    pages = _PAGES_RE.search(catalog) if catalog else None
+    tree = _object(data, pages.groups()) if pages else None
+    count = _COUNT_RE.search(tree) if tree else None
+    if count:
+        return int(count.group(1))
+    # The catalog is in a compressed object stream
+    return len(pypdf.PdfReader(io.BytesIO(data)).pages)
+
+def pdf_info(data, num_pages=None):
+    return {
+        'num_pages': count_pages(data) if num_pages is None else num_pages,
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'size': len(data),
+    }
@@ -1,8 +1,74 @@
 import subprocess
 import json
+import os
+import queue
+import re
+import threading
+
+from metrics import metrics
+
+class RmapiSessionError(RuntimeError):
+    pass
+
+class RmapiSession:
+    """A long-lived rmapi shell driven over stdin/stdout.
+
+    Keeps the auth token and document tree loaded between commands. rmapi's
+    shell has no delimiter for command output, so every command is followed by
+    `version`, whose (known) output marks where the command's output ends.
+    """
+    def __init__(self, sentinel, timeout=600, env=None):
+        self.sentinel = sentinel
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.lines = queue.Queue()
+        self.proc = subprocess.Popen(["rmapi", "-ni"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        threading.Thread(target=self._read_stdout, daemon=True).start()
+
+    def _read_stdout(self):
+        for line in self.proc.stdout:
+            self.lines.put(line.decode(errors='replace'))
+        self.lines.put(None)
+
+    def run(self, commands):
+        """Runs one or more commands, returning their combined output lines."""
+        if isinstance(commands, str):
+            commands = [commands]
+        with self.lock:
+            if self.proc.poll() is not None:
+                raise RmapiSessionError(f'rmapi exited with code {self.proc.returncode}')
+            script = ''.join(f'{c}\n' for c in commands) + 'version\n'
+            try:
+                self.proc.stdin.write(script.encode())
+                self.proc.stdin.flush()
+            except OSError as e:
+                raise RmapiSessionError(f'rmapi stdin closed: {e}')
+
+            out = []
+            while True:
+                try:
+                    line = self.lines.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise RmapiSessionError(f'timed out waiting for rmapi: {commands}')
+                if line is None:
+                    raise RmapiSessionError(f'rmapi exited during {commands}: {out}')
+                line = _PROMPT.sub('', line.rstrip('\n'))
+                if line.strip() == self.sentinel:
+                    return out
+                out.append(line)
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+                self.proc.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
 
 class Remarkable:
-    def __init__(self):
+    """reMarkable cloud access through rmapi, with the tokens in ~/.rmapi, or
+    in the rmapi config file at config if one is given."""
+    def __init__(self, persistent=True, config=None):
         import rmapy.const
         rmapy.const.AUTH_BASE_URL = "https://webapp-prod.cloud.remarkable.engineering"
         rmapy.const.BASE_URL = "https://internal.cloud.remarkable.com"
@@ -11,12 +77,25 @@ class Remarkable:
 
         from rmapy.api import Client
         self.shim = Client()
+        self.config = config
+        self.env = None
+        if config:
+            # rmapi reads RMAPI_CONFIG, but rmapy only ever reads ~/.rmapi
+            self.env = {**os.environ, 'RMAPI_CONFIG': config}
+            self.shim.token_set = _load_tokens(config)
 
+        self.persistent = persistent
+        # One rmapi shell per thread, so uploads can run in parallel
+        self.local = threading.local()
+        self.sessions = []
         self.check_rmapi_binary()
     
     def auth_if_needed(self, token):
         if not self.is_auth():
             print("Not authenticated")
+            if token and self.config:
+                # rmapy would save the new tokens to ~/.rmapi
+                raise RuntimeError(f"Can't register a device for {self.config}: run rmapi with RMAPI_CONFIG={self.config} to register it")
             if token:
                 print("Using register-device-token: '%s'" % token)
                 self.register_device(token)
@@ -43,46 +122,153 @@ class Remarkable:
         return self.shim.renew_token()
     
     def check_rmapi_binary(self):
-        out = subprocess.run(["rmapi", "version"], capture_output=True)
+        out = subprocess.run(["rmapi", "version"], capture_output=True, env=self.env)
         if out.returncode != 0:
             raise RuntimeError(f"Couldn't find rmapi binary: exit code {out.returncode}: {out.stdout} {out.stderr}")
+        self.version = out.stdout.decode().strip()
+
+    def _session(self):
+        if not self.persistent or not self.version:
+            return None
+        session = getattr(self.local, 'session', None)
+        if not session or session.proc.poll() is not None:
+            session = RmapiSession(self.version, env=self.env)
+            self.local.session = session
+            self.sessions.append(session)
+        return session
+
+    def _run(self, verb, *args):
+        """Runs an rmapi command, returning (ok, output).
+
+        Uses the persistent session when possible. If the session breaks, it is
+        shut down and read-only commands are retried with a one-shot rmapi process;
+        writes aren't retried, since they may already have been applied.
+        """
+        with metrics.timer('rmapi_seconds', verb=verb):
+            ok, out = self._run_command(verb, *args)
+        if not ok:
+            metrics.inc('rmapi_errors_total', verb=verb)
+        return ok, out
+
+    def _run_command(self, verb, *args):
+        session = self._session()
+        if session:
+            try:
+                out = session.run(' '.join([verb] + [_quote(a) for a in args]))
+                errors = [l for l in out if not l.startswith(('[f]', '[d]')) and (l.lstrip().startswith('Error') or "doesn't exist" in l)]
+                return not errors, '\n'.join(out)
+            except RmapiSessionError as e:
+                print(f'rmapi session failed, falling back to one-shot rmapi: {e}')
+                session.close()
+                self.persistent = False
+                if verb not in ('ls', 'stat'):
+                    raise
+        out = subprocess.run(["rmapi", "-ni", verb, *args], capture_output=True, env=self.env)
+        return out.returncode == 0, f'{out.stdout.decode()}{out.stderr.decode()}'
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+        self.sessions = []
+
+    def refresh(self):
+        """Closes the rmapi shells, which only load the document tree when they
+        start, so that the next commands see the cloud as it is now: with the
+        reading progress made since, and uploads made by other threads' shells."""
+        self.close()
 
     def ls(self, folder, ftype='[f]'):
-        out = subprocess.run(["rmapi", "-ni", "ls", folder], capture_output=True)
-        if out.returncode != 0 and "directory doesn't exist" in str(out.stderr):
-            raise FileNotFoundError(f"{out.stderr}")
-        elif out.returncode != 0:
-            raise RuntimeError(f"Couldn't run ls: exit code {out.returncode}: {out.stdout} {out.stderr}")
+        ok, out = self._run("ls", folder)
+        if not ok and "directory doesn't exist" in out:
+            raise FileNotFoundError(out)
+        elif not ok:
+            raise RuntimeError(f"Couldn't run ls: {out}")
 
-        files = out.stdout.decode().splitlines()
+        files = out.splitlines()
         files = list(map(lambda x: x.split('\t'), files))
-        files = list(filter(lambda x: x[0] == ftype, files))
+        files = list(filter(lambda x: len(x) > 1 and x[0] == ftype, files))
         files = list(map(lambda x: x[1], files))
 
         return files
 
     def mkdir(self, folder):
-        mk = subprocess.run(["rmapi", "mkdir", folder], capture_output=True)
-        if mk.returncode != 0:
-            raise RuntimeError(f"Couldn't create directory: exit code {mk.returncode}: {mk.stdout} {mk.stderr}")
+        ok, out = self._run("mkdir", folder)
+        if not ok:
+            raise RuntimeError(f"Couldn't create directory: {out}")
         return True
 
     def put(self, local_path, remote_folder):
-        write = subprocess.run(["rmapi", "-ni", "put", local_path, remote_folder], capture_output=True)
-        if write.returncode != 0:
-            raise RuntimeError(f"Couldn't write file: exit code {write.returncode}: {write.stdout} {write.stderr}")
+        ok, out = self._run("put", local_path, remote_folder)
+        if not ok:
+            raise RuntimeError(f"Couldn't write file: {out}")
         return True
 
     def stat(self, remote_path):
-        out = subprocess.run(["rmapi", "-ni", "stat", remote_path], capture_output=True)
-        if out.returncode != 0:
-            raise RuntimeError(f"Couldn't stat file: exit code {out.returncode}: {out.stdout} {out.stderr}")
-        return json.loads(out.stdout)
+        ok, out = self._run("stat", remote_path)
+        stats = list(_iter_json_objects(out)) if ok else []
+        if not stats:
+            raise RuntimeError(f"Couldn't stat file: {out}")
+        return stats[0]
+
+    def snapshot(self, folder, files):
+        """Stats every given file in folder in a single round trip to rmapi.
+
+        Returns a dict of filename to stat output. Files which couldn't be
+        stat'ed are left out, so callers can fall back to stat().
+        """
+        if not files:
+            return {}
+        commands = [f'stat {_quote(folder + "/" + f)}' for f in files]
+        session = self._session()
+        out = None
+        if session:
+            try:
+                out = '\n'.join(session.run(commands))
+            except RmapiSessionError as e:
+                print(f'rmapi session failed, falling back to one-shot rmapi: {e}')
+                session.close()
+                self.persistent = False
+        if out is None:
+            run = subprocess.run(["rmapi", "-ni"], input=''.join(f'{c}\n' for c in commands).encode(), capture_output=True, env=self.env)
+            if run.returncode != 0:
+                raise RuntimeError(f"Couldn't snapshot folder: exit code {run.returncode}: {run.stdout} {run.stderr}")
+            out = run.stdout.decode()
+
+        stats = {}
+        for obj in _iter_json_objects(out):
+            if isinstance(obj, dict) and obj.get('VissibleName') in files:
+                stats[obj['VissibleName']] = obj
+        return stats
 
     def rm(self, remote_path):
-        out = subprocess.run(["rmapi", "-ni", "rm", remote_path], capture_output=True)
-        if out.returncode != 0:
-            raise RuntimeError(f"Couldn't rm file: exit code {out.returncode}: {out.stdout} {out.stderr}")
+        ok, out = self._run("rm", remote_path)
+        if not ok:
+            raise RuntimeError(f"Couldn't rm file: {out}")
         return True
 
 
+_PROMPT = re.compile(r'^(\[[^\]]*\]>\s*)+')
+
+def _quote(arg):
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _iter_json_objects(text):
+    # rmapi's shell interleaves prompts with command output, so pick out
+    # each JSON object wherever it starts
+    decoder = json.JSONDecoder()
+    i = text.find('{')
+    while i != -1:
+        try:
+            obj, end = decoder.raw_decode(text, i)
+            yield obj
+            i = text.find('{', end)
+        except json.JSONDecodeError:
+            i = text.find('{', i + 1)
+
+def _load_tokens(path):
+    import yaml
+    config = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            config = yaml.safe_load(f) or {}
+    return {'devicetoken': config.get('devicetoken', ''), 'usertoken': config.get('usertoken', '')}
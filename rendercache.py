@@ -0,0 +1,63 @@
+import hashlib
+import os
+import shutil
+import threading
+
+class RenderCache:
+    """Size-capped cache of rendered PDFs, evicting the least recently used.
+
+    Entries are addressed by a hash of whatever identifies a render, such as
+    the post id and revision, so an edited post gets rendered again.
+    """
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256('\0'.join(str(p) for p in parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, f'{key}.pdf')
+
+    def get(self, key, dest):
+        """Copies the cached PDF for key to dest, returning whether there was one."""
+        path = self._path(key)
+        with self.lock:
+            if not os.path.exists(path):
+                return False
+            # mtime tracks when an entry was last used, for eviction
+            os.utime(path)
+            os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+            shutil.copyfile(path, dest)
+        return True
+
+    def put(self, key, src):
+        path = self._path(key)
+        tmp = f'{path}.tmp'
+        with self.lock:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, path)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith('.pdf'):
+                continue
+            st = os.stat(os.path.join(self.folder, name))
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print(f'Evicting {name} from render cache')
+            os.remove(os.path.join(self.folder, name))
+            total -= size
+
+def post_revision(post):
+    # Prefer a field which changes when the post is edited, if Substack sent one
+    return post.get('updated_at') or post.get('post_date')
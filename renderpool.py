@@ -0,0 +1,337 @@
+import collections
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import htmlrender
+from metrics import metrics
+from pdfutil import InvalidPdf, postprocess_pdf, record_postprocess
+from sstack import Substack, browser_context, new_context
+
+# Backoff, in seconds, before launching a render worker's browser again
+RELAUNCH_DELAY = 5
+RELAUNCH_MAX_DELAY = 300
+
+def _claim(fut):
+    """Marks fut as running, unless it was cancelled. A job put back on the
+    queue after it started, to render it in the browser, is already running."""
+    return fut.running() or fut.set_running_or_notify_cancel()
+
+class FairQueue:
+    """Render jobs queued per account, which get() takes from each account in
+    turn, so one account's backlog doesn't hold up the others' renders.
+
+    None, which stops a worker, is only returned once every job has been taken.
+    """
+    def __init__(self):
+        self.queues = collections.OrderedDict()
+        self.stops = 0
+        self.cond = threading.Condition()
+
+    def put(self, job, account=None):
+        with self.cond:
+            if job is None:
+                self.stops += 1
+            else:
+                self.queues.setdefault(account, collections.deque()).append(job)
+            self.cond.notify()
+
+    def _take(self):
+        for account, jobs in self.queues.items():
+            if jobs:
+                self.queues.move_to_end(account)
+                return jobs.popleft()
+        if self.stops:
+            self.stops -= 1
+            return None
+        raise queue.Empty
+
+    def get(self, timeout=None):
+        """Raises queue.Empty if no job comes within timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                try:
+                    return self._take()
+                except queue.Empty:
+                    left = None if deadline is None else deadline - time.monotonic()
+                    if left is not None and left <= 0:
+                        raise
+                    self.cond.wait(left)
+
+    def get_nowait(self):
+        with self.cond:
+            return self._take()
+
+class RenderPool:
+    """Renders articles to PDF on a bounded number of worker threads.
+
+    Playwright's sync API can't be shared between threads, so every worker
+    owns its own browser and context, loaded with the saved Substack cookies.
+    Workers are only started by the first submit(), so a run with nothing to
+    render never launches Chromium, and launch a new browser if theirs dies.
+
+    Articles submitted with their HTML are printed with weasyprint, if it is
+    installed, on threads of their own which never start a browser; otherwise
+    a worker prints the HTML without loading the article page or signing in.
+
+    Printed PDFs are checked, optimized and written out by postprocess_pdf()
+    in a pool of postprocess_workers processes, so the CPU work of pypdf
+    neither holds up the next render nor competes with it for the GIL.
+
+    One pool can render for several Substack accounts, each registered with
+    add_account(). Every worker's browser then has a context and Substack
+    session per account, and takes their jobs in turn. The cookie_file,
+    relogin_command, device and substack_kwargs given here make up the
+    default account, None.
+    """
+    def __init__(self, concurrency, cookie_file=None, headless=True, slow_mo=0, relogin_command=None, device='a4',
+                 postprocess_workers=2, strip_metadata=False, **substack_kwargs):
+        self.postprocess_workers = max(1, postprocess_workers)
+        self.strip_metadata = strip_metadata
+        self.headless = headless
+        self.slow_mo = slow_mo
+        self.accounts = {}
+        if cookie_file:
+            self.add_account(None, cookie_file, relogin_command=relogin_command, device=device, **substack_kwargs)
+
+        self.concurrency = max(1, concurrency)
+        self.jobs = FairQueue()
+        self.workers = []
+        self.html_executor = None
+        self.processes = None
+        self.closing = False
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.workers:
+                return
+            for i in range(self.concurrency):
+                t = threading.Thread(target=self._worker, name=f'render-{i}', daemon=True)
+                t.start()
+                self.workers.append(t)
+
+    def add_account(self, account, cookie_file, relogin_command=None, device='a4', **substack_kwargs):
+        """Registers the Substack account whose articles are submitted as account."""
+        self.accounts[account] = {
+            'cookie_file': cookie_file,
+            'relogin_command': relogin_command,
+            'device': device,
+            'substack_kwargs': substack_kwargs,
+        }
+
+    def submit(self, url, output_file, html=None, expected_words=None, account=None):
+        """Renders url to output_file, returning a future of its pdf_info(), or
+        of a falsy value if the article couldn't be printed. expected_words is
+        the post's wordcount, to reject renders cut off short of it."""
+        fut = Future()
+        if self.closing:
+            fut.set_exception(RuntimeError('the render pool is closed'))
+            return fut
+        job = (fut, url, output_file, html, expected_words, account)
+        if html and htmlrender.weasyprint:
+            with self.lock:
+                if not self.html_executor:
+                    self.html_executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='render-html')
+            self.html_executor.submit(self._write_html, job)
+        else:
+            self._start()
+            self.jobs.put(job, account)
+        return fut
+
+    def _write_html(self, job):
+        fut, url, output_file, html, expected_words, account = job
+        if fut.cancelled():
+            return
+        try:
+            with metrics.timer('render_seconds', renderer='weasyprint'):
+                data = htmlrender.write_pdf(html, url)
+        except Exception as e:
+            self._render_in_browser(job, e)
+            return
+        self._postprocess(job, data)
+
+    def _render_in_browser(self, job, error):
+        fut, url, output_file, html, expected_words, account = job
+        if self.closing:
+            if _claim(fut):
+                fut.set_exception(error)
+            return
+        print(f'Unable to render the HTML of {url}, rendering it in the browser: {error}')
+        self._start()
+        self.jobs.put((fut, url, output_file, None, expected_words, account), account)
+
+    def _processes(self, broken=None):
+        """Returns the postprocess pool, replacing it if it is broken, the pool
+        a worker process died in."""
+        with self.lock:
+            if broken and self.processes is broken:
+                broken.shutdown(wait=False)
+                self.processes = None
+            if not self.processes:
+                # Forking would copy the Playwright threads' locks in whatever state they are in
+                self.processes = ProcessPoolExecutor(max_workers=self.postprocess_workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.processes
+
+    def _postprocess(self, job, data, broken=None):
+        """Completes the job's future with postprocess_pdf() of data, run in a
+        worker process. A job submitted with its HTML, whether weasyprint or
+        the browser printed it, falls back to rendering the article page when
+        the PDF is rejected."""
+        fut, url, output_file, html, expected_words, account = job
+        device = self.accounts[account]['device']
+        processes = self._processes(broken)
+        try:
+            pfut = processes.submit(postprocess_pdf, data, output_file, device, expected_words, self.strip_metadata)
+        except BrokenProcessPool as e:
+            self._resubmit(job, data, processes, broken, e)
+            return
+        except RuntimeError as e:
+            # Shut down by close(cancel=True)
+            if _claim(fut):
+                fut.set_exception(e)
+            return
+
+        def done(pfut):
+            try:
+                info = pfut.result()
+            except BrokenProcessPool as e:
+                self._resubmit(job, data, processes, broken, e)
+                return
+            except Exception as e:
+                if isinstance(e, InvalidPdf):
+                    print(f'Rejected the render of {url}: {e}')
+                    metrics.inc('invalid_renders_total', reason=str(e))
+                if html:
+                    self._render_in_browser(job, e)
+                else:
+                    fut.set_exception(e)
+                return
+            record_postprocess(info)
+            if _claim(fut):
+                fut.set_result(info)
+        pfut.add_done_callback(done)
+
+    def _resubmit(self, job, data, processes, broken, error):
+        """Postprocesses the job again in a new pool, after a worker process
+        died and broke processes, e.g. killed for running out of memory. Only
+        once: a job whose PDF breaks the new pool too fails."""
+        fut = job[0]
+        if self.closing or broken:
+            if _claim(fut):
+                fut.set_exception(error)
+            return
+        print(f'A postprocess worker died, restarting them: {error}')
+        metrics.inc('postprocess_restarts_total')
+        self._postprocess(job, data, broken=processes)
+
+    def close(self, cancel=False):
+        if self.html_executor:
+            # May still fall back to the browser workers, so finish before stopping them
+            self.html_executor.shutdown(wait=not cancel, cancel_futures=cancel)
+        self.closing = True
+        if cancel:
+            # Drop queued renders, and don't wait for the ones in progress
+            while True:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job and not job[0].cancel():
+                    # Put back after it started, so it can't be cancelled any more
+                    job[0].set_exception(RuntimeError('the render pool was closed'))
+        for _ in self.workers:
+            self.jobs.put(None)
+        if not cancel:
+            for t in self.workers:
+                t.join()
+        if self.processes:
+            self.processes.shutdown(wait=not cancel, cancel_futures=cancel)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(cancel=exc_type is not None)
+
+    def _worker(self):
+        # A browser which dies is replaced, and one which fails to launch is
+        # launched again after a backoff, failing the jobs taken meanwhile, so
+        # a pool kept open by --daemon doesn't end up without working browsers
+        name = threading.current_thread().name
+        failures = 0
+        while True:
+            launched = False
+            try:
+                with browser_context(self.headless, self.slow_mo) as context:
+                    launched = True
+                    failures = 0
+                    if self._run_jobs(context):
+                        return
+                    print(f'[{name}] the browser was disconnected')
+            except Exception as e:
+                if not launched:
+                    failures += 1
+                    delay = min(RELAUNCH_MAX_DELAY, RELAUNCH_DELAY * 2 ** (failures - 1))
+                    print(f'[{name}] unable to launch the browser, trying again in {delay}s: {e}')
+                    if self._run_jobs(None, error=e, until=time.monotonic() + delay):
+                        return
+                    continue
+                print(f'[{name}] the browser failed: {e}')
+            print(f'[{name}] launching a new browser')
+            metrics.inc('browser_relaunches_total')
+
+    def _substack(self, sessions, browser, context, account):
+        ss = sessions.get(account)
+        if not ss:
+            a = self.accounts[account]
+            # The first account takes the context the browser was launched with,
+            # every other one gets its own, so they never share cookies
+            ss = Substack(new_context(browser) if sessions else context, cookie_file=a['cookie_file'], refresh_cookies=False,
+                          device=a['device'], **a['substack_kwargs'])
+            sessions[account] = ss
+        return ss
+
+    def _run_jobs(self, context, error=None, until=None):
+        """Renders jobs in context, or fails them with error, until the pool is
+        closed, returning True, or until the browser was disconnected or the
+        time until has passed, returning False."""
+        browser = context.browser if context else None
+        sessions = {}
+        while True:
+            if browser and not browser.is_connected():
+                return False
+            try:
+                job = self.jobs.get(timeout=None if until is None else max(0, until - time.monotonic()))
+            except queue.Empty:
+                return False
+            if job is None:
+                return True
+            fut, url, output_file, html, expected_words, account = job
+            if not _claim(fut):
+                continue
+            if error:
+                fut.set_exception(error)
+                continue
+            try:
+                ss = self._substack(sessions, browser, context, account)
+                if html:
+                    data = ss.render_html(url, html)
+                else:
+                    data = ss.download_pdf(url, headless=self.headless, slow_mo=self.slow_mo, relogin_command=self.accounts[account]['relogin_command'])
+            except Exception as e:
+                if html:
+                    self._render_in_browser(job, e)
+                else:
+                    fut.set_exception(e)
+                continue
+            if data:
+                self._postprocess(job, data)
+            elif html:
+                self._render_in_browser(job, RuntimeError('nothing was printed'))
+            else:
+                fut.set_result(data)
@@ -0,0 +1,92 @@
+import json
+import os
+import urllib.parse
+
+from metrics import metrics
+
+# Analytics, ads, chat widgets and players which add nothing to a printed article
+DEFAULT_BLOCK_HOSTS = [
+    'google-analytics.com',
+    'googletagmanager.com',
+    'doubleclick.net',
+    'googlesyndication.com',
+    'connect.facebook.net',
+    'facebook.com',
+    'analytics.twitter.com',
+    'static.ads-twitter.com',
+    'cdn.segment.com',
+    'api.segment.io',
+    'sentry.io',
+    'ingest.sentry.io',
+    'browser-intake-datadoghq.com',
+    'js.stripe.com',
+    'm.stripe.network',
+    'intercom.io',
+    'widget.intercom.io',
+    'hotjar.com',
+    'plausible.io',
+    'quantserve.com',
+    'scorecardresearch.com',
+    'youtube.com',
+    'youtube-nocookie.com',
+    'player.vimeo.com',
+    'open.spotify.com',
+    'embed.podcasts.apple.com',
+]
+
+# Resource types which never show up in a PDF
+DEFAULT_BLOCK_RESOURCE_TYPES = ['media', 'websocket', 'eventsource', 'manifest', 'texttrack']
+
+def _host_matches(host, hosts):
+    return any(host == h or host.endswith(f'.{h}') for h in hosts)
+
+class RequestFilter:
+    """Aborts requests made while rendering an article which the PDF doesn't need.
+
+    Requests to block_hosts, or of block_resource_types, are blocked unless
+    their host is in the allow list of the publication being rendered, which
+    maps an article's domain to the hosts it needs (e.g. a podcast publication
+    whose player should be printed).
+    """
+    def __init__(self, block_hosts=None, block_resource_types=None, allow=None):
+        self.block_hosts = DEFAULT_BLOCK_HOSTS if block_hosts is None else block_hosts
+        self.block_resource_types = DEFAULT_BLOCK_RESOURCE_TYPES if block_resource_types is None else block_resource_types
+        self.allow = allow or {}
+
+    @classmethod
+    def load(cls, path):
+        """Builds a filter from the defaults, extended by the JSON file at path if there is one."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as f:
+            config = json.load(f)
+        print(f'Using request filter settings from {path}')
+        return cls(
+            block_hosts=DEFAULT_BLOCK_HOSTS + config.get('block_hosts', []),
+            block_resource_types=config.get('block_resource_types', DEFAULT_BLOCK_RESOURCE_TYPES),
+            allow=config.get('allow', {}),
+        )
+
+    def block_reason(self, url, resource_type, article_domain=None):
+        """Returns why a request should be blocked, or None to let it through."""
+        host = urllib.parse.urlsplit(url).hostname or ''
+        if _host_matches(host, self.allow.get(article_domain, [])):
+            return None
+        if resource_type in self.block_resource_types:
+            return resource_type
+        if _host_matches(host, self.block_hosts):
+            return 'host'
+        return None
+
+    def handle(self, route, article_domain=None):
+        request = route.request
+        # Never block the article itself
+        if request.is_navigation_request() and request.frame.parent_frame is None:
+            route.continue_()
+            return
+        reason = self.block_reason(request.url, request.resource_type, article_domain)
+        if reason:
+            metrics.inc('blocked_requests_total', reason=reason)
+            route.abort('blockedbyclient')
+        else:
+            route.continue_()
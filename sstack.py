@@ -5,16 +5,241 @@ import urllib.parse
 import json
 import time
 import subprocess
+import threading
+import contextlib
+import random
 
-from playwright.sync_api import sync_playwright
+from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 from playwright_stealth import Stealth
 
-login_failures = 0
-login_successes = 0
+from metrics import metrics, process_tree_bytes
+from pdfutil import DEVICE_PROFILES, InvalidPdf, page_css, postprocess_pdf
+
+# Overridden to point at a local stand-in by the benchmarks in bench/
+BASE_URL = os.environ.get('SUBSTACK_BASE_URL', 'https://substack.com')
+
+def new_context(browser):
+    return browser.new_context(
+        viewport={'width': 1920, 'height': 1080},
+        user_agent='Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36',
+        locale='en-US',
+        timezone_id='America/New_York',
+    )
+
+def driver_pid(obj):
+    """Returns the pid of the Playwright driver behind a Playwright object such
+    as a browser context, or None if it can't be found. Every sync_playwright()
+    starts its own driver, so the driver's process tree is the browser one
+    render worker launched."""
+    try:
+        return obj._impl_obj._connection._transport._proc.pid
+    except AttributeError:
+        return None
+
+@contextlib.contextmanager
+def browser_context(headless=True, slow_mo=0):
+    """Launches a Chromium browser, yielding a new context in it."""
+    with Stealth().use_sync(sync_playwright()) as p:
+        browser = p.chromium.launch(headless=headless, slow_mo=slow_mo)
+        try:
+            yield new_context(browser)
+        finally:
+            browser.close()
+
+# The cookie which keeps a substack.com login
+SESSION_COOKIE = 'substack.sid'
+
+class RateLimiter:
+    """Per-host rate limiting shared by API requests and page navigations.
+
+    Each host gets a token bucket refilled at `rate` requests per second. A 429
+    blocks the host for its Retry-After (or an exponential backoff with jitter)
+    and halves the host's rate, which then recovers gradually on successful
+    requests. Shared between render workers, so it is safe to call from
+    multiple threads.
+    """
+    def __init__(self, rate=0.5, burst=4, max_retries=5, base_delay=5, max_delay=300):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _host(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = {'tokens': self.burst, 'updated': time.monotonic(), 'rate': self.rate, 'blocked_until': 0}
+        return host, self.hosts[host]
+
+    def acquire(self, url):
+        while True:
+            with self.lock:
+                host, h = self._host(url)
+                now = time.monotonic()
+                h['tokens'] = min(self.burst, h['tokens'] + (now - h['updated']) * h['rate'])
+                h['updated'] = now
+                wait = h['blocked_until'] - now
+                if wait <= 0 and h['tokens'] >= 1:
+                    h['tokens'] -= 1
+                    return
+                if wait <= 0:
+                    wait = (1 - h['tokens']) / h['rate']
+            if wait > 1:
+                print(f'Rate limiting {host} for {wait:.1f}s')
+            metrics.observe('rate_limit_wait_seconds', wait, host=host)
+            time.sleep(wait)
+
+    def success(self, url):
+        with self.lock:
+            host, h = self._host(url)
+            h['rate'] = min(self.rate, h['rate'] + self.rate / 10)
+
+    def backoff(self, url, attempt, retry_after=None):
+        """Records a 429 from url's host, raising once the retry budget is used up."""
+        if attempt >= self.max_retries:
+            raise RuntimeError(f'429: still rate limited after {attempt} retries: {url}')
+        delay = None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                pass
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+        with self.lock:
+            host, h = self._host(url)
+            metrics.inc('http_429_total', host=host)
+            h['blocked_until'] = max(h['blocked_until'], time.monotonic() + delay)
+            h['rate'] = max(self.rate / 16, h['rate'] / 2)
+            h['tokens'] = min(h['tokens'], 0)
+        print(f'429 from {host}, backing off {delay:.1f}s (retry {attempt + 1}/{self.max_retries})')
+
+class RenderDeadline:
+    """Time budget for rendering a single article.
+
+    Every wait in the render pipeline is capped by the time left in the budget,
+    and the time spent inside waits is tracked separately from the rest.
+    """
+    def __init__(self, seconds):
+        self.start = time.monotonic()
+        self.end = self.start + seconds
+        self.waited = 0
+
+    def timeout(self, cap_ms):
+        remaining = (self.end - time.monotonic()) * 1000
+        if remaining <= 0:
+            raise TimeoutError('article render deadline exceeded')
+        return min(cap_ms, remaining)
+
+    @contextlib.contextmanager
+    def waiting(self):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.waited += time.monotonic() - start
+
+    def report(self):
+        total = time.monotonic() - self.start
+        return f'{total:.1f}s total, {self.waited:.1f}s waiting, {total - self.waited:.1f}s working'
+
+# Any of these being present means the article content has rendered
+ARTICLE_BODY_SELECTOR = '.available-content, .body.markup, article'
+# Paywall detection - multiple selectors for different paywall presentations
+ARTICLE_PAYWALL_SELECTOR = ', '.join([
+    '[aria-label="Paywall"]',                           # region with aria-label
+    'text="This post is for paid subscribers"',         # exact paywall heading text
+    'a:has-text("Already a paid subscriber")',          # subscriber sign-in link
+    '[class*="paywall" i]',                             # CSS class containing paywall
+])
+
+# Loads every lazy image and embed on the page in a single round trip, instead
+# of scrolling through the page to trigger them. Resolves to a summary of what
+# was loaded once everything has settled or the timeout passed.
+FORCE_LAZY_LOAD_JS = '''async (timeout) => {
+    const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+    for (const el of document.querySelectorAll('[data-src], [data-srcset]')) {
+        if (el.dataset.src) el.src = el.dataset.src;
+        if (el.dataset.srcset) el.srcset = el.dataset.srcset;
+    }
+    const lazyFrames = Array.from(document.querySelectorAll('iframe[loading="lazy"]'));
+    for (const el of [...document.querySelectorAll('img[loading="lazy"]'), ...lazyFrames]) {
+        el.loading = 'eager';
+    }
+    // Re-assigning srcset makes the browser pick a candidate now, including
+    // for <picture> sources that were skipped while off-screen
+    for (const el of document.querySelectorAll('picture source[srcset], img[srcset]')) {
+        el.srcset = el.srcset;
+    }
+    // Some embeds only render once they have been scrolled into view
+    const root = document.scrollingElement || document.body;
+    root.scrollTop = root.scrollHeight;
+    await sleep(0);
+    root.scrollTop = 0;
+
+    // A frame that had already loaded won't fire load again, so frames get a short cap
+    const images = Array.from(document.images);
+    await Promise.race([
+        Promise.all([
+            ...images.map(img => img.decode().catch(() => null)),
+            ...lazyFrames.map(frame => new Promise(resolve => {
+                frame.addEventListener('load', resolve, {once: true});
+                frame.addEventListener('error', resolve, {once: true});
+                setTimeout(resolve, Math.min(timeout, 3000));
+            })),
+        ]),
+        sleep(timeout),
+    ]);
+    return {
+        images: images.length,
+        pending: images.filter(img => !img.complete).length,
+        iframes: lazyFrames.length,
+    };
+}'''
+
 class Substack:
-    def __init__(self, context, cookie_file=None, login_url=None):
+    def __init__(self, context, cookie_file=None, login_url=None, refresh_cookies=True, limiter=None, login_check_interval=None,
+                 render_timeout=120, report_wait_time=False, lazy_load_mode='inpage', http_cache=None, subscriptions_ttl=None, device='a4',
+                 request_filter=None, recycle_page_after=None, recycle_context_mb=None):
         self.context = context
+        self.device = device
+        self.request_filter = request_filter
+        # Domain of the article being rendered, for the request filter's per-publication allow lists
+        self.article_domain = None
+
+        # Memory watchdog: the page is replaced after recycle_page_after
+        # renders, and the whole context once its browser's memory passes
+        # recycle_context_mb, so garbage doesn't pile up over a long run
+        self.recycle_page_after = recycle_page_after
+        self.recycle_context_mb = recycle_context_mb
+        self.page_renders = 0
+        self.context_renders = 0
         self.page = None
+        self.http_cache = http_cache
+        self.subscriptions_ttl = subscriptions_ttl
+        self.limiter = limiter or RateLimiter()
+        self.navigating = False
+        # A 429 which a navigation made by a click got, as (url, retry_after)
+        self.pending_429 = None
+        self.render_timeout = render_timeout
+        self.report_wait_time = report_wait_time
+        self.lazy_load_mode = lazy_load_mode
+        self.deadline = RenderDeadline(render_timeout)
+
+        # Session validity cache: the substack.com login is verified once and
+        # then trusted for login_check_interval seconds (None: for the whole run),
+        # and custom domains are only signed in to once per context.
+        self.login_check_interval = login_check_interval
+        self.login_verified_at = None
+        # Kept per session, so that with --accounts one account's renders
+        # don't use up another's relogin
+        self.login_failures = 0
+        self.login_successes = 0
+        self.relogin_commands_run = set()
+        self.cookies_added = False
+        self.signed_in_domains = set()
 
         self.s = requests.Session()
         self.cookies = None
@@ -29,59 +254,95 @@ class Substack:
         else:
             print(f'Using existing substack cookie file {cookie_file=}')
             self.read_cookies()
-            self.launch_homepage_and_save_cookies()
+            if refresh_cookies:
+                self.launch_homepage_and_save_cookies()
     
     def _new_page(self):
         p = self.context.new_page()
-        def _refresh_if_429(response):
-            if response.status == 429 and not ('api/v1' in response.url):
-                print('429, waiting', response.url)
-                time.sleep(5)
-                p.reload()
-                p.wait_for_load_state()
-        p.on('response', _refresh_if_429)
+        def _record_429(response):
+            # Navigations made by clicks don't go through _goto: the 429 is
+            # waited out, and the page reloaded, by _reload_after_429()
+            if response.status == 429 and response.request.resource_type == 'document' and not self.navigating:
+                self.pending_429 = (response.url, response.headers.get('retry-after'))
+        p.on('response', _record_429)
+        if self.request_filter:
+            p.route('**/*', lambda route: self.request_filter.handle(route, self.article_domain))
+            def _record_bytes(response):
+                length = response.headers.get('content-length')
+                if length and length.isdigit():
+                    metrics.inc('loaded_bytes_total', int(length), resource_type=response.request.resource_type)
+            p.on('response', _record_bytes)
         return p
 
+    def cookies_expire_within(self, seconds):
+        """Returns whether the saved substack.com session cookie is missing or expires in the next seconds.
+
+        Only the session cookie counts: the saved cookies also include
+        short-lived ones, such as Cloudflare's, which don't need refreshing.
+        """
+        sessions = [c for c in self.cookies or []
+                    if c.get('name') == SESSION_COOKIE and (c.get('domain') or '').endswith('substack.com')]
+        if not sessions:
+            return True
+        expiries = [c['expires'] for c in sessions if (c.get('expires') or -1) > 0]
+        return bool(expiries) and min(expiries) - time.time() < seconds
+
+    def refresh_in_browser(self, login_url=None, headless=True, slow_mo=0):
+        """Logs in with login_url, or refreshes the saved cookies, in a short-lived browser."""
+        with browser_context(headless, slow_mo) as context:
+            self.context = context
+            try:
+                if login_url:
+                    self.login(login_url)
+                else:
+                    self.launch_homepage_and_save_cookies()
+            finally:
+                self.context = None
+                self.page = None
+        self.read_cookies()
+
     def login(self, login_url, headless=True):
         #r = self.s.get(login_url, allow_redirects=True)
         print('[login] Opening playwright:', login_url)
         if not self.page:
             self.page = self._new_page()
         page = self.page
-        page.goto(login_url)
+        self.deadline = RenderDeadline(self.render_timeout)
+        self._goto(page, login_url)
         page.wait_for_load_state()
         page.wait_for_timeout(5000)
         try:
             page.evaluate('location.reload()')
         except:
             print('location.reload() failed')
-        page.goto(login_url)
+        self._goto(page, login_url)
         page.wait_for_load_state()
         try:
             page.evaluate('location.reload()')
         except:
             print('location.reload() failed')
-        page.goto('https://substack.com/home')
+        self._goto(page, f'{BASE_URL}/home')
         page.wait_for_load_state()
         c = self.context.cookies()
         print('[login] got cookies: %s' % c)
         self.write_cookies(c)
     
     def launch_homepage_and_save_cookies(self):
-        print('[launch] Opening playwright: https://substack.com/home')
+        print(f'[launch] Opening playwright: {BASE_URL}/home')
         if self.cookies:
             print(f'adding {len(self.cookies)} cookies')
             self.context.add_cookies(self.cookies)
         if not self.page:
             self.page = self._new_page()
         page = self.page
-        page.goto('https://substack.com/home')
+        self.deadline = RenderDeadline(self.render_timeout)
+        self._goto(page, f'{BASE_URL}/home')
         page.wait_for_load_state()
         try:
             page.evaluate('location.reload()')
         except:
             print('location.reload() failed')
-        page.goto('https://substack.com/home')
+        self._goto(page, f'{BASE_URL}/home')
         page.wait_for_load_state()
         c = self.context.cookies()
         print('[launch] got cookies: %s' % c)
@@ -120,150 +381,350 @@ class Substack:
 
 
     
-    def get_posts(self, inbox_type='inbox', limit=12, after=None): # max limit enforced by substack: 20
-        url = f'https://substack.com/api/v1/reader/posts?inboxType={inbox_type}&limit={limit}'
-        if after:
-            url += f'&after={after}'
-        r = self.s.get(url)
+    def _get_json(self, url, ttl=None):
+        headers = {}
+        if self.http_cache:
+            cached = self.http_cache.fresh(url, ttl)
+            if cached is not None:
+                metrics.inc('api_cache_hits_total')
+                return cached
+            headers = self.http_cache.request_headers(url)
+
+        attempt = 0
+        while True:
+            self.limiter.acquire(url)
+            with metrics.timer('api_request_seconds', host=urllib.parse.urlsplit(url).netloc):
+                r = self.s.get(url, headers=headers)
+            if r.status_code != 429:
+                break
+            self.limiter.backoff(url, attempt, r.headers.get('Retry-After'))
+            attempt += 1
+        self.limiter.success(url)
+
+        if self.http_cache:
+            return self.http_cache.store(url, r, ttl)
         if r.status_code//100 != 2:
             raise RuntimeError(f'{r.status_code}: {r.text}')
         return r.json()
+    
+    def get_posts(self, inbox_type='inbox', limit=12, after=None): # max limit enforced by substack: 20
+        url = f'{BASE_URL}/api/v1/reader/posts?inboxType={inbox_type}&limit={limit}'
+        if after:
+            url += f'&after={after}'
+        return self._get_json(url)
 
     def get_archive(self, domain, limit=12, offset=None): # max limit enforced by substack: 20
         url = f'https://{domain}/api/v1/archive?sort=new&search=&limit={limit}'
         if offset:
             url += f'&offset={offset}'
-        r = self.s.get(url)
-        if r.status_code == 429:
-            print('429, waiting')
-            time.sleep(5)
-        if r.status_code//100 != 2:
-            raise RuntimeError(f'{r.status_code}: {r.text}')
-        return r.json()
+        return self._get_json(url)
 
-    def get_full_archive(self, domain):
-        out = []
+    def iter_archive(self, domain, limit=20):
+        """Yields each page of domain's archive, newest first."""
         offset = None
-        c = 0
         while True:
-            try:
-                ret = self.get_archive(domain, limit=12, offset=offset)
-            except RuntimeError as e:
-                if '429:' in str(e):
-                    time.sleep(15)
-                    continue
-                else:
-                    raise e
-            print(f'get_archive({offset=})')
+            ret = self.get_archive(domain, limit=limit, offset=offset)
+            print(f'get_archive({domain=}, {offset=})')
             if not ret:
-                print(f'get_full_archive done {len(out)}')
-                return out
-            c += 1
+                return
+            yield ret
+            offset = (offset or 0) + len(ret)
+
+    def get_full_archive(self, domain):
+        out = []
+        for ret in self.iter_archive(domain):
             out += ret
-            if offset:
-                offset += 12
-            else:
-                offset = 12
-            if c % 5 == 0:
-                time.sleep(5)
-            time.sleep(1)
+        print(f'get_full_archive done {len(out)}')
+        return out
 
-    def get_subscriptions(self):
-        r = self.s.get(f'https://substack.com/api/v1/subscriptions')
-        if r.status_code//100 != 2:
-            raise RuntimeError(f'{r.status_code}: {r.text}')
-        return r.json()
+    def get_subscriptions(self, refresh=False):
+        return self._get_json(f'{BASE_URL}/api/v1/subscriptions', ttl=None if refresh else self.subscriptions_ttl)
+
+    def get_post(self, url):
+        u = urllib.parse.urlsplit(url)
+        slug = u.path.rstrip('/').split('/')[-1]
+        return self._get_json(f'{u.scheme}://{u.netloc}/api/v1/posts/{slug}')
 
     # def playwright_cookies(self):
     #     return [{'name': k.name, 'value': k.value, 'port': k.port, 'domain': k.domain, 'path': k.path, 'secure': k.secure, 'expires': k.expires} for k in self.s.cookies]
 
 
-    relogin_command_run = False
+    def _login_status(self):
+        print(f'STATUS login_failures={self.login_failures} login_successes={self.login_successes}')
+
     def download_pdf(self, *args, **kwargs):
-        global login_successes
-        global login_failures
         for i in range(3):
             try:
                 ret = self._download_pdf(*args, retry=i, **kwargs)
                 if ret:
-                    login_successes += 1
-                    print(f'STATUS {login_failures=} {login_successes=}')
+                    self.login_successes += 1
+                    metrics.inc('article_logins_total', result='success')
+                    self._login_status()
                     return ret
             except Exception as e:
                 print('download_pdf call', i+1, 'swallowed exception', e)
             print('Retrying download_pdf()')
         ret = self._download_pdf(*args, retry=3, **kwargs)
         if not ret:
-            login_failures += 1
-            if kwargs.get('relogin_command') and not self.relogin_command_run and login_successes == 0:
-                print(f'STATUS {login_failures=} {login_successes=}')
+            self.login_failures += 1
+            metrics.inc('article_logins_total', result='failure')
+            if kwargs.get('relogin_command') and kwargs.get('relogin_command') not in self.relogin_commands_run and self.login_successes == 0:
+                self._login_status()
                 subprocess.run(['/bin/bash', '-c', kwargs.get('relogin_command')])
-                self.relogin_command_run = True
+                self.relogin_commands_run.add(kwargs.get('relogin_command'))
         else:
-            login_successes += 1
-            print(f'STATUS {login_failures=} {login_successes=}')
+            self.login_successes += 1
+            metrics.inc('article_logins_total', result='success')
+            self._login_status()
         return ret
 
-    def _download_pdf(self, url, output_file, headless=True, slow_mo=0, relogin_command=None, retry=0):
-        print('Opening playwright:', url)
+    def _login_is_fresh(self):
+        if self.login_verified_at is None:
+            return False
+        if self.login_check_interval is None:
+            return True
+        return time.monotonic() - self.login_verified_at < self.login_check_interval
 
+    def check_logged_in(self):
         _logged_in_locator = 'button:has-text("New post"), [placeholder*="What\'s on your mind"]'
         _logged_out_locator = 'button:has-text("Sign in")'
-        
-        if self.cookies:
-            print(f'adding {len(self.cookies)} cookies')
-            self.context.add_cookies(self.cookies)
-        if not self.page:
-            self.page = self._new_page()
-        page = self.page
 
-        print('Opening https://substack.com/home')
-        page.goto('https://substack.com/home')
-        page.wait_for_load_state()
-        page.wait_for_timeout(5000)
-        print('Opened https://substack.com/home')
+        page = self.page
+        print(f'Opening {BASE_URL}/home')
+        self._goto(page, f'{BASE_URL}/home')
+        self._wait_for_load(page, 'networkidle', timeout=5000)
+        print(f'Opened {BASE_URL}/home')
         
         # Check for logged-in state: either find logged-in element OR confirm sign-in button is absent
         logged_in = False
         try:
-            page.locator(_logged_in_locator).first.wait_for(timeout=2000)
+            with self.deadline.waiting():
+                page.locator(_logged_in_locator).first.wait_for(timeout=self.deadline.timeout(2000))
             logged_in = True
-        except Exception:
+        except PlaywrightTimeoutError:
             # Fallback: check if sign-in button is NOT visible (indicates logged in)
             try:
                 sign_in_visible = page.locator(_logged_out_locator).first.is_visible()
                 logged_in = not sign_in_visible
             except Exception:
                 pass
-        
-        if not logged_in:
-            print('Unable to ensure logged-in on substack homepage, you need to relogin')
-            return None
-        print('Found logged-in session on substack.com')
 
-        page.goto(url)
+        self.login_verified_at = time.monotonic() if logged_in else None
+        return logged_in
+
+    def _navigate(self, url, go):
+        with self.deadline.waiting():
+            self.limiter.acquire(url)
+            self.navigating = True
+            try:
+                return go(timeout=self.deadline.timeout(30000))
+            finally:
+                self.navigating = False
+
+    def _reload_after_429(self, page):
+        """Waits out the 429 a click's navigation got, if any, and reloads the page."""
+        if not self.pending_429:
+            return
+        url, retry_after = self.pending_429
+        self.pending_429 = None
+        attempt = 0
+        while True:
+            self.limiter.backoff(url, attempt, retry_after)
+            attempt += 1
+            response = self._navigate(url, lambda timeout: page.reload(wait_until='domcontentloaded', timeout=timeout))
+            if not response or response.status != 429:
+                self.limiter.success(url)
+                return
+            retry_after = response.headers.get('retry-after')
+
+    def _goto(self, page, url):
+        if self.pending_429:
+            # Leaving the page, so the host's backoff is all that's left to do
+            pending_url, retry_after = self.pending_429
+            self.pending_429 = None
+            self.limiter.backoff(pending_url, 0, retry_after)
+        attempt = 0
+        while True:
+            response = self._navigate(url, lambda timeout: page.goto(url, wait_until='domcontentloaded', timeout=timeout))
+            if not response or response.status != 429:
+                self.limiter.success(url)
+                return response
+            self.limiter.backoff(url, attempt, response.headers.get('retry-after'))
+            attempt += 1
+
+    def _wait_for_load(self, page, state='load', timeout=5000):
         try:
-            page.wait_for_load_state(timeout=5000)
-        except:
-            print('load state ignored')
+            with self.deadline.waiting():
+                page.wait_for_load_state(state, timeout=self.deadline.timeout(timeout))
+        except PlaywrightTimeoutError:
+            print(f'{state} load state ignored')
+
+    def _wait_for_selector(self, page, selector, timeout=5000):
+        try:
+            with self.deadline.waiting():
+                page.locator(selector).first.wait_for(state='attached', timeout=self.deadline.timeout(timeout))
+            return True
+        except PlaywrightTimeoutError:
+            return False
+
+    def _wait_for_article(self, page):
+        self._wait_for_load(page, 'load')
+        self._wait_for_selector(page, f'{ARTICLE_BODY_SELECTOR}, {ARTICLE_PAYWALL_SELECTOR}')
+
+    def _wait_for_fonts(self, page):
+        with self.deadline.waiting():
+            page.evaluate('''(timeout) => Promise.race([
+                document.fonts.ready,
+                new Promise(resolve => setTimeout(resolve, timeout)),
+            ])''', self.deadline.timeout(5000))
+
+    def _wait_for_images(self, page):
+        with self.deadline.waiting():
+            page.evaluate('''(timeout) => Promise.race([
+                Promise.all(Array.from(document.images).map(img => img.decode().catch(() => null))),
+                new Promise(resolve => setTimeout(resolve, timeout)),
+            ])''', self.deadline.timeout(10000))
+
+    def _force_lazy_load(self, page):
+        print("Loading lazy images...")
+        with self.deadline.waiting():
+            ret = page.evaluate(FORCE_LAZY_LOAD_JS, self.deadline.timeout(15000))
+        print(f"Done loading lazy images: {ret}")
+
+    def _scroll_to_load(self, page):
+        print("Starting scroll...")
+        lastScrollY = -1000
+        curScrollY = page.evaluate('(document.scrollingElement || document.body).scrollTop')
+        scrolled = 0
+        while curScrollY > lastScrollY:
+            N = 250
+            page.mouse.wheel(0, N)
+            scrolled += N
+            page.wait_for_timeout(50)
+            lastScrollY = curScrollY
+            curScrollY = page.evaluate('(document.scrollingElement || document.body).scrollTop')
+
+        print("Resetting to top")
+        page.mouse.wheel(0, -1 * scrolled)
+        self._wait_for_images(page)
+        print("Done scrolling")
+
+    def _recycle_if_needed(self):
+        used_mb = 0
+        if self.recycle_context_mb:
+            # Only this context's own browser, not the ones other render workers launched
+            pid = driver_pid(self.context)
+            used_mb = process_tree_bytes(pid) / 1024 / 1024 if pid else 0
+        # A context which hasn't rendered anything yet won't get any smaller by recycling it
+        if self.recycle_context_mb and used_mb > self.recycle_context_mb and self.context_renders > 0:
+            print(f'Browser memory is {used_mb:.0f}MB, over {self.recycle_context_mb}MB: recycling the browser context')
+            self._recycle_context()
+        elif self.page and self.recycle_page_after and self.page_renders >= self.recycle_page_after:
+            print(f'Recycling the page after {self.page_renders} renders')
+            metrics.inc('recycled_total', kind='page')
+            self.page.close()
+            self.page = None
+            self.page_renders = 0
+
+    def _recycle_context(self):
+        # Carry the cookies over, including the sessions signed in on custom domains
+        cookies = self.context.cookies()
+        old = self.context
+        self.context = new_context(old.browser)
+        self.context.add_cookies(cookies)
+        self.cookies_added = True
+        self.page = None
+        self.page_renders = 0
+        self.context_renders = 0
+        old.close()
+        metrics.inc('recycled_total', kind='context')
+
+    def _load_lazy_content(self, page):
+        with metrics.timer('render_stage_seconds', stage='lazy_load'):
+            if self.lazy_load_mode == 'scroll':
+                self._scroll_to_load(page)
+            else:
+                self._force_lazy_load(page)
+
+    def _print_pdf(self, page):
+        """Prints the page, returning the PDF's bytes for postprocess_pdf()."""
+        self.page_renders += 1
+        self.context_renders += 1
+        with metrics.timer('render_stage_seconds', stage='pdf'):
+            return page.pdf(prefer_css_page_size=True)
+
+    def render_html(self, url, page_html):
+        """Prints an article's HTML, fetched from the API, without loading the article page itself."""
+        print('Rendering HTML for:', url)
+        self.deadline = RenderDeadline(self.render_timeout)
+        self.article_domain = urllib.parse.urlparse(url).netloc
+        start = time.monotonic()
+        try:
+            self._recycle_if_needed()
+            if not self.page:
+                self.page = self._new_page()
+            page = self.page
+            with self.deadline.waiting(), metrics.timer('render_stage_seconds', stage='navigate'):
+                page.set_content(page_html, wait_until='load', timeout=self.deadline.timeout(30000))
+            page.emulate_media(media="print")
+            self._wait_for_fonts(page)
+            self._load_lazy_content(page)
+            return self._print_pdf(page)
+        finally:
+            metrics.observe('render_seconds', time.monotonic() - start, renderer='html')
+            if self.report_wait_time:
+                print(f'Render time for {url}: {self.deadline.report()}')
+
+    def _download_pdf(self, url, headless=True, slow_mo=0, relogin_command=None, retry=0):
+        print('Opening playwright:', url)
+        self.deadline = RenderDeadline(self.render_timeout)
+        start = time.monotonic()
+        try:
+            return self._render_article(url, retry)
+        finally:
+            metrics.observe('render_seconds', time.monotonic() - start, renderer='browser')
+            if self.report_wait_time:
+                print(f'Render time for {url}: {self.deadline.report()}')
+
+    def _render_article(self, url, retry):
+        self._recycle_if_needed()
+        if self.cookies and not self.cookies_added:
+            print(f'adding {len(self.cookies)} cookies')
+            self.context.add_cookies(self.cookies)
+            self.cookies_added = True
+        if not self.page:
+            self.page = self._new_page()
+        page = self.page
+
+        domain = urllib.parse.urlparse(url).netloc
+        self.article_domain = domain
+        if retry > 0:
+            # Don't trust the cached session state if a previous attempt failed
+            self.login_verified_at = None
+            self.signed_in_domains.discard(domain)
+
+        with metrics.timer('render_stage_seconds', stage='signin'):
+            if self._login_is_fresh():
+                print('Reusing logged-in session on substack.com')
+            elif not self.check_logged_in():
+                print('Unable to ensure logged-in on substack homepage, you need to relogin')
+                return None
+            else:
+                print('Found logged-in session on substack.com')
+
+        with metrics.timer('render_stage_seconds', stage='navigate'):
+            self._goto(page, url)
+            self._wait_for_article(page)
         print('Ensuring logged-in session carries to article details')
         
         # For article pages, check for sign-in link/button (can be <a> or <button>)
         # Cross-domain cookies require clicking sign-in to transfer session
         _article_signin_selector = ':is(a, button):has-text("Sign in")'
-        # Paywall detection - multiple selectors for different paywall presentations
-        _article_paywall_selector = ', '.join([
-            '[aria-label="Paywall"]',                           # region with aria-label
-            'text="This post is for paid subscribers"',         # exact paywall heading text
-            'a:has-text("Already a paid subscriber")',          # subscriber sign-in link
-            '[class*="paywall" i]',                             # CSS class containing paywall
-        ])
         
         def check_article_logged_in():
             """Check if we're logged in on an article page by looking for paywall indicators"""
             try:
-                page.wait_for_timeout(500)
-                has_paywall = page.locator(_article_paywall_selector).first.is_visible()
+                has_paywall = page.locator(ARTICLE_PAYWALL_SELECTOR).first.is_visible()
                 return not has_paywall
             except Exception:
                 return True
@@ -277,7 +738,7 @@ class Substack:
                     print('Found sign-in link, clicking for cross-domain cookie transfer')
                     signin_link.click()
                     signin_clicked = True
-                    page.wait_for_load_state(timeout=5000)
+                    self._wait_for_load(page)
             except Exception as e:
                 print(f'Sign-in link click failed: {e}')
             
@@ -293,139 +754,104 @@ class Substack:
                     si = page.locator('[data-href*="sign-in"]').first
                     si_url = si.get_attribute('data-href')
                     si.click()
-                    page.wait_for_load_state(timeout=2000)
-                    page.goto(si_url)
-                    page.wait_for_load_state(timeout=2000)
+                    self._wait_for_load(page, timeout=2000)
+                    self._goto(page, si_url)
+                    self._wait_for_load(page, timeout=2000)
                     signin_clicked = True
                 except:
                     print('no data-href=sign-in')
             return signin_clicked
+
+        def complete_signin():
+            """Load the substack.com home page so the carried-over session is stored, then return to the article"""
+            self._wait_for_load(page)
+            # Outside try_signin_carryover(), whose clicks swallow any error
+            self._reload_after_429(page)
+            print(f'Opening {BASE_URL}/home to complete signin')
+            self._goto(page, f'{BASE_URL}/home')
+            self._wait_for_load(page, 'networkidle', timeout=5000)
+            print("Returning to article page")
+            self._goto(page, url)
+            self._wait_for_article(page)
         
-        # ALWAYS try to click sign-in on article pages for cross-domain cookie transfer
-        page.wait_for_timeout(1000)
-        signin_visible = False
-        try:
-            signin_visible = page.locator(_article_signin_selector).first.is_visible()
-        except:
-            pass
+        with metrics.timer('render_stage_seconds', stage='signin'):
+            if domain in self.signed_in_domains:
+                if check_article_logged_in():
+                    print(f'Session already carried over to {domain}')
+                else:
+                    print(f'Paywall shown on {domain} despite earlier signin, re-checking login')
+                    self.signed_in_domains.discard(domain)
+                    if not self.check_logged_in():
+                        print('Unable to ensure logged-in on substack homepage, you need to relogin')
+                        return None
+                    self._goto(page, url)
+                    self._wait_for_article(page)
+
+            if domain not in self.signed_in_domains:
+                # ALWAYS try to click sign-in on article pages for cross-domain cookie transfer
+                signin_visible = False
+                try:
+                    signin_visible = page.locator(_article_signin_selector).first.is_visible()
+                except:
+                    pass
         
-        if signin_visible:
-            print('Sign-in visible on article page, clicking for cross-domain cookie transfer')
-            try_signin_carryover()
-            page.wait_for_timeout(1000)
-            print('Opening https://substack.com/home to complete signin')
-            page.goto('https://substack.com/home')
-            try:
-                page.wait_for_load_state(timeout=5000)
-            except:
-                print('load state ignored')
-            page.wait_for_timeout(2000)
-            print("Returning to article page")
-            page.goto(url)
-            try:
-                page.wait_for_load_state(timeout=5000)
-            except:
-                print('load state ignored')
-            page.wait_for_timeout(1000)
+                if signin_visible:
+                    print('Sign-in visible on article page, clicking for cross-domain cookie transfer')
+                    try_signin_carryover()
+                    complete_signin()
         
-        # Check if we have paywall after signin attempt
-        if not check_article_logged_in():
-            print('Paywall detected after first signin attempt, retrying...')
-            try_signin_carryover()
-            try:
-                page.wait_for_load_state(timeout=5000)
-            except:
-                print('load state ignored')
-            page.wait_for_timeout(1000)
-            print('Opening https://substack.com/home again')
-            page.goto('https://substack.com/home')
-            try:
-                page.wait_for_load_state(timeout=5000)
-            except:
-                print('load state ignored')
-            page.wait_for_timeout(2000)
-            print("Returning to article page after signin carryover")
-            page.goto(url)
-            try:
-                page.wait_for_load_state(timeout=5000)
-            except:
-                print('load state ignored')
-            page.wait_for_timeout(2000)
-            
-            if not check_article_logged_in():
-                print('TIMED OUT: still seeing paywall on', url)
-                return None
-            else:
-                print('Paywall cleared!')
-        page.wait_for_timeout(1000)
+                # Check if we have paywall after signin attempt
+                if not check_article_logged_in():
+                    print('Paywall detected after first signin attempt, retrying...')
+                    try_signin_carryover()
+                    complete_signin()
+                
+                    if not check_article_logged_in():
+                        print('TIMED OUT: still seeing paywall on', url)
+                        return None
+                    else:
+                        print('Paywall cleared!')
+                self.signed_in_domains.add(domain)
         page.emulate_media(media="print")
-        page.wait_for_timeout(1000)
-        page.add_style_tag(content='''                           
-@page {
-    size: A4;
-    margin: 20mm !important;
-}
-@media all {
-    @page {
-        size: A4;
-        margin: 20mm !important;
-    }
-
-    article {
-        margin: 0 20mm !important;
-    }
-
-    div#discussion, .publication-footer, .footer {
-        display: none !important;
-    }
-
-    html, body {
-        width: 250mm;
-    }
-}
-        ''')
-        page.wait_for_timeout(1000)
-        print("Starting scroll...")
-        lastScrollY = -1000
-        curScrollY = page.evaluate('(document.scrollingElement || document.body).scrollTop')
-        scrolled = 0
-        while curScrollY > lastScrollY:
-            N = 250
-            page.mouse.wheel(0, N)
-            scrolled += N
-            page.wait_for_timeout(50)
-            lastScrollY = curScrollY
-            curScrollY = page.evaluate('(document.scrollingElement || document.body).scrollTop')
-
-        print("Resetting to top")
-        page.mouse.wheel(0, -1 * scrolled)
-        page.wait_for_timeout(1000)
-        print("Done scrolling")
-        page.pdf(path=output_file, prefer_css_page_size=True)
-        return True
+        page.add_style_tag(content=page_css(self.device))
+        self._wait_for_fonts(page)
+        self._load_lazy_content(page)
+        return self._print_pdf(page)
 
 if __name__ == '__main__':
     import argparse
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from httpcache import HttpCache
+    from renderpool import RenderPool
+    from rendercache import RenderCache, post_revision
+    from htmlrender import fetch_article_html
+    from requestfilter import RequestFilter
 
     a = argparse.ArgumentParser(description="Writes recent Substack articles to reMarkable cloud")
     a.add_argument('--download-url', help='URL to download PDF for')
-    a.add_argument('--download-domain', help='Substack domain to download all PDFs for')
+    a.add_argument('--download-domain', nargs='+', action='extend', help='Substack domain(s) to download all PDFs for')
+    a.add_argument('--render-concurrency', type=int, default=2, help='Number of archive posts to render in parallel, each in its own browser')
     a.add_argument('--config-folder', help='Configuration folder for remarkable-substack', default='')
     a.add_argument('--substack-login-url', help='For initial authentication with Substack: the URL from the email received from Substack when entering your email on the login page')
     a.add_argument('--non-headless', help='Debug by not having headless browser', action='store_true')
     a.add_argument('--output-folder', help='Output folder', default='out')
     a.add_argument('--relogin-command', help='Command to run when relogin is required (e.g. send a notification)', default=None)
     a.add_argument('--slow-mo', help='Slow down browser actions by this many milliseconds', default=0, type=int)
+    a.add_argument('--report-wait-time', action='store_true', help='Print how much of each article render was spent waiting on the page')
+    a.add_argument('--device', choices=DEVICE_PROFILES.keys(), default='a4', help='Device to size pages and images for')
+    a.add_argument('--renderer', choices=['html', 'browser'], default='html', help='Render archive posts whose full text is in the post API from that HTML, or always load them in the browser')
+    a.add_argument('--no-request-filter', action='store_true', help='Let article pages load analytics, embedded players and media, which are blocked by default')
+    a.add_argument('--recycle-page-after', type=int, default=10, help='Open a fresh browser page after rendering this many articles in one. Set to 0 to disable')
+    a.add_argument('--recycle-context-mb', type=int, default=450, help='Recycle a render browser\'s context when the memory (PSS) of that browser\'s processes passes this many MB. Set to 0 to disable')
+    a.add_argument('--render-cache-mb', type=int, default=200, help='Size of the cache of rendered PDFs in the config folder. Set to 0 to disable')
+    a.add_argument('--postprocess-workers', type=int, default=2, help='Number of processes checking and optimizing rendered PDFs')
+    a.add_argument('--strip-pdf-metadata', action='store_true', help='Remove the document information and XMP metadata from rendered PDFs')
+    a.add_argument('--lazy-load-mode', choices=['inpage', 'scroll'], default='inpage', help='How to load lazy images before rendering: in a single page script, or by scrolling through the page')
     args = a.parse_args()
     with Stealth().use_sync(sync_playwright()) as p:
         chromium = p.chromium
         browser = chromium.launch(headless=not args.non_headless, slow_mo=args.slow_mo)
-        context = browser.new_context(
-            viewport={'width': 1920, 'height': 1080},
-            user_agent='Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36',
-            locale='en-US',
-            timezone_id='America/New_York',
-        )
+        context = new_context(browser)
 
         if not args.config_folder:
             args.config_folder = os.path.join(os.path.expanduser('~'), '.config', 'remarkable-substack')
@@ -434,31 +860,91 @@ if __name__ == '__main__':
             print(f'Set --config-folder to {args.config_folder}')
 
         cookie_file = os.path.join(args.config_folder, '.substack-cookie')
-        ss = Substack(context, cookie_file=cookie_file, login_url=args.substack_login_url)
+        http_cache = HttpCache(os.path.join(args.config_folder, 'http-cache'))
+        request_filter = None if args.no_request_filter else RequestFilter.load(os.path.join(args.config_folder, 'request-filter.json'))
+        ss = Substack(context, cookie_file=cookie_file, login_url=args.substack_login_url, report_wait_time=args.report_wait_time, lazy_load_mode=args.lazy_load_mode,
+                      http_cache=http_cache, device=args.device, request_filter=request_filter)
+        render_cache = None
+        if args.render_cache_mb > 0:
+            render_cache = RenderCache(os.path.join(args.config_folder, 'render-cache'), args.render_cache_mb * 1024 * 1024)
+
         if args.download_url:
             path = f'{args.output_folder}/article.pdf'
-            print(f'Downloading {args.download_url=} {path=}')
-            ret = ss.download_pdf(args.download_url, path, headless=not args.non_headless, slow_mo=args.slow_mo)
-            print(f'Result: {ret}')
+            cache_key = None
+            if render_cache:
+                # Keyed on the post's revision, like main.py's, so an edited post is rendered again
+                try:
+                    post = ss.get_post(args.download_url)
+                    cache_key = RenderCache.key(post['id'], post_revision(post), args.device)
+                except Exception as e:
+                    print(f'Unable to fetch {args.download_url} from the post API, not using the render cache: {e}')
+            if cache_key and render_cache.get(cache_key, path):
+                print(f'Using cached render of {args.download_url=} for {path=}')
+            else:
+                print(f'Downloading {args.download_url=} {path=}')
+                ret = ss.download_pdf(args.download_url, headless=not args.non_headless, slow_mo=args.slow_mo)
+                if ret:
+                    try:
+                        ret = postprocess_pdf(ret, path, args.device, strip_metadata=args.strip_pdf_metadata)
+                    except InvalidPdf as e:
+                        print(f'Not saving {path=}, the render is {e}')
+                        ret = None
+                if ret and cache_key:
+                    render_cache.put(cache_key, path)
+                print(f'Result: {ret}')
 
         if args.download_domain:
-            archive = ss.get_full_archive(args.download_domain)
-            with open(f'{args.output_folder}/{args.download_domain}.json','w') as f:
-                f.write(json.dumps(archive, indent=4))
-
-            print(f'{len(archive)=}')
-            root = f'{args.output_folder}/{args.download_domain}'
-            if not os.path.exists(root):
-                os.makedirs(root, exist_ok=True)
-
-            for item in archive:
-                date = item['post_date'].split('T')[0]
-                title = item['title'].replace('/','-')
-                path = os.path.join(root, f'{date} - {title}.pdf')
-                if os.path.exists(path):
-                    print(f'File {path=} already exists, skipping')
-                    continue
-                print(f'Downloading {date=} {title=} {path=}')
-                ret = ss.download_pdf(item['canonical_url'], path, headless=not args.non_headless, relogin_command=args.relogin_command, slow_mo=args.slow_mo)
-                print(f'Result: {ret}')
+            # Archives are paged concurrently, one thread per domain, and each post
+            # is queued for rendering as soon as its archive page arrives
+            renders = {}
+            renders_lock = threading.Lock()
+
+            def backfill(domain):
+                root = f'{args.output_folder}/{domain}'
+                if not os.path.exists(root):
+                    os.makedirs(root, exist_ok=True)
+
+                archive = []
+                for items in ss.iter_archive(domain):
+                    archive += items
+                    for item in items:
+                        date = item['post_date'].split('T')[0]
+                        title = item['title'].replace('/','-')
+                        path = os.path.join(root, f'{date} - {title}.pdf')
+                        if os.path.exists(path):
+                            print(f'File {path=} already exists, skipping')
+                            continue
+                        cache_key = RenderCache.key(item['id'], post_revision(item), args.device)
+                        if render_cache and render_cache.get(cache_key, path):
+                            print(f'Using cached render for {path=}')
+                            continue
+                        html = None
+                        if args.renderer == 'html':
+                            html = fetch_article_html(ss, item['canonical_url'], args.device)
+                        print(f'Queueing {domain=} {date=} {title=} {path=}')
+                        with renders_lock:
+                            renders[pool.submit(item['canonical_url'], path, html=html, expected_words=item.get('wordcount'))] = (path, cache_key)
+
+                with open(f'{args.output_folder}/{domain}.json','w') as f:
+                    f.write(json.dumps(archive, indent=4))
+                print(f'{domain}: {len(archive)=}')
+
+            with RenderPool(args.render_concurrency, cookie_file, headless=not args.non_headless, slow_mo=args.slow_mo,
+                            relogin_command=args.relogin_command, limiter=ss.limiter,
+                            report_wait_time=args.report_wait_time, lazy_load_mode=args.lazy_load_mode, device=args.device,
+                            request_filter=request_filter, recycle_page_after=args.recycle_page_after,
+                            recycle_context_mb=args.recycle_context_mb, postprocess_workers=args.postprocess_workers,
+                            strip_metadata=args.strip_pdf_metadata) as pool:
+                with ThreadPoolExecutor(max_workers=len(args.download_domain)) as archives:
+                    for fut in as_completed([archives.submit(backfill, domain) for domain in args.download_domain]):
+                        fut.result()
 
+                for fut in as_completed(renders):
+                    path, cache_key = renders[fut]
+                    try:
+                        ret = fut.result()
+                    except Exception as e:
+                        ret = e
+                    if ret and not isinstance(ret, Exception) and render_cache:
+                        render_cache.put(cache_key, path)
+                    print(f'Result: {path} {ret}')
@@ -0,0 +1,96 @@
+import json
+import os
+import sqlite3
+import threading
+
+COLUMNS = ['id', 'publication_id', 'post_date', 'canonical_url', 'filename', 'num_pages', 'added', 'deleted', 'current_page', 'progress_updated']
+
+class ArticleStore:
+    """SQLite-backed record of every article which has been saved to the device.
+
+    Replaces db_file.json: lookups are indexed and every change is committed
+    as it happens, instead of parsing and rewriting one JSON blob per run.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS articles (
+                    id TEXT PRIMARY KEY,
+                    publication_id INTEGER,
+                    post_date TEXT,
+                    canonical_url TEXT,
+                    filename TEXT,
+                    num_pages INTEGER,
+                    added REAL,
+                    deleted REAL,
+                    current_page INTEGER,
+                    progress_updated REAL
+                )''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS articles_on_device ON articles (deleted, added)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def migrate_json(self, db_file):
+        """Imports articles from the old db_file.json, once."""
+        if not os.path.exists(db_file) or self.get_meta('migrated_json'):
+            return
+        with open(db_file, 'r') as f:
+            article_data = json.load(f)
+        print(f'Migrating {len(article_data)} articles from {db_file}')
+        with self.lock, self.db:
+            for id, info in article_data.items():
+                self._upsert({**info, 'id': id})
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('migrated_json', db_file))
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else None
+
+    def __contains__(self, id):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM articles WHERE id = ?', (id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def get(self, id):
+        with self.lock:
+            row = self.db.execute('SELECT * FROM articles WHERE id = ?', (id,)).fetchone()
+        return dict(row) if row else None
+
+    def _upsert(self, info):
+        values = {k: info.get(k) for k in COLUMNS}
+        updates = ', '.join(f'{k} = COALESCE(excluded.{k}, {k})' for k in COLUMNS if k != 'id')
+        self.db.execute(f'''
+            INSERT INTO articles ({', '.join(COLUMNS)}) VALUES ({', '.join('?' for _ in COLUMNS)})
+            ON CONFLICT (id) DO UPDATE SET {updates}''', [values[k] for k in COLUMNS])
+
+    def add(self, info):
+        with self.lock, self.db:
+            self._upsert(info)
+
+    def mark_deleted(self, id, ts):
+        with self.lock, self.db:
+            self.db.execute('UPDATE articles SET deleted = ? WHERE id = ?', (ts, id))
+
+    def update_progress(self, id, current_page, ts):
+        with self.lock, self.db:
+            self.db.execute('UPDATE articles SET current_page = ?, progress_updated = ? WHERE id = ?', (current_page, ts, id))
+
+    def oldest_unread_on_device(self, ids=None):
+        """Returns the id of the earliest added article which is still on the device and not read to the end, optionally limited to ids."""
+        query = 'SELECT id FROM articles WHERE deleted IS NULL AND (current_page IS NULL OR current_page + 1 < num_pages)'
+        params = []
+        if ids is not None:
+            ids = list(ids)
+            query += f' AND id IN ({", ".join("?" for _ in ids)})'
+            params = ids
+        with self.lock:
+            row = self.db.execute(query + ' ORDER BY added, id LIMIT 1', params).fetchone()
+        return row['id'] if row else None
+
+    def close(self):
+        self.db.close()